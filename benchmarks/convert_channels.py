@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Board of Regents of the University of Wisconsin System
+
+"""Usage: convert_channels.py [options]
+
+Times converting random frames' 24-bit channels to int32 with the original
+convert_channels_to_le_i4() and with reader.unpack_channels(), both into a
+new array and straight into an INTERNAL_DTYPE array's channels field.
+
+Options:
+  --frames=<n>   How many frames to convert [default: 100000]
+  --repeat=<n>   Take the best of this many runs [default: 5]
+"""
+
+from __future__ import print_function
+
+import time
+
+import numpy as np
+
+from read_itek import reader
+from read_itek.vendor.docopt import docopt
+
+
+def legacy_convert_channels_to_le_i4(frames):
+    # The conversion read_itek used before reader.unpack_channels()
+    int32_data = np.zeros((len(frames), reader.CHANNELS), '<i4')
+    int32_data.dtype = np.byte
+    int32_data = int32_data.reshape(len(frames), reader.CHANNELS, 4)
+    int32_data[:, 0:9, 0:3] = frames['chans08to00'][:, ::-1, ::-1]
+    int32_data[:, 9:29, 0:3] = frames['chans28to09'][:, ::-1, ::-1]
+    int32_data[:, 29:49, 0:3] = frames['chans48to29'][:, ::-1, ::-1]
+    int32_data[:, 49:69, 0:3] = frames['chans68to49'][:, ::-1, ::-1]
+    int32_data[:, 69:89, 0:3] = frames['chans88to69'][:, ::-1, ::-1]
+    int32_data[:, 89:109, 0:3] = frames['chans108to89'][:, ::-1, ::-1]
+    int32_data[:, 109:128, 0:3] = frames['chans127to109'][:, ::-1, ::-1]
+    sign_mask = int32_data[:, :, 2] < 0
+    int32_data[:, :, 3][sign_mask] = -1
+    int32_data = int32_data.reshape(len(frames), reader.CHANNELS * 4)
+    int32_data.dtype = '<i4'
+    return int32_data
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv=argv)
+    frame_count = int(args['--frames'])
+    repeat = int(args['--repeat'])
+    rng = np.random.RandomState(0)
+    frames = rng.randint(
+        0, 256, frame_count * reader.FRAME_DTYPE.itemsize).astype(
+        np.uint8).view(reader.FRAME_DTYPE)
+    internal_struct = reader.empty_internal_type(frame_count)
+
+    expected = legacy_convert_channels_to_le_i4(frames)
+    assert np.array_equal(reader.unpack_channels(frames), expected)
+
+    cases = [
+        ('legacy, then copy into INTERNAL_DTYPE', lambda: internal_struct[
+            'channels'].__setitem__(
+                slice(None), legacy_convert_channels_to_le_i4(frames))),
+        ('legacy', lambda: legacy_convert_channels_to_le_i4(frames)),
+        ('unpack_channels', lambda: reader.unpack_channels(frames)),
+        ('unpack_channels into INTERNAL_DTYPE', lambda: reader.unpack_channels(
+            frames, internal_struct['channels'])),
+    ]
+    print('\t'.join(['method', 'seconds', 'megasamples_per_second']))
+    for label, convert in cases:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            convert()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('\t'.join([
+            label,
+            '{:.4f}'.format(best),
+            '{:.1f}'.format(frame_count * reader.CHANNELS / best / 1.0e6),
+        ]))
+
+
+if __name__ == '__main__':
+    main()
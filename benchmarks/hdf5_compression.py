@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Board of Regents of the University of Wisconsin System
+
+"""Usage: hdf5_compression.py [options] <itf_file>
+
+Converts <itf_file> with itf2hdf5's compression settings, and prints the
+write time, the time to read every channel back, and the file size for each
+setting as tab-separated values.
+
+Options:
+  --jobs=<n>       Threads to compress with, where the filters allow it
+                   [default: 1]
+  --repeat=<n>     Take the best of this many runs [default: 3]
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+
+import h5py
+
+from read_itek import itf2hdf5
+from read_itek import reader
+from read_itek.vendor.docopt import docopt
+
+# (label, codec, level, shuffle, fletcher32)
+SETTINGS = [
+    ('none', 'none', 0, False, False),
+    ('lzf', 'lzf', 0, False, False),
+    ('lzf+shuffle', 'lzf', 0, True, False),
+    ('gzip1', 'gzip', 1, False, False),
+    ('gzip4', 'gzip', 4, False, False),
+    ('gzip4+shuffle', 'gzip', 4, True, False),
+    ('gzip9+shuffle', 'gzip', 9, True, False),
+    ('gzip4+shuffle+fletcher32', 'gzip', 4, True, True),
+    ('blosc5+shuffle', 'blosc', 5, True, False),
+    ('zstd3', 'zstd', 3, False, False),
+]
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv=argv)
+    itf_file = args['<itf_file>']
+    jobs = int(args['--jobs'])
+    repeat = int(args['--repeat'])
+    reader.logger.setLevel('WARNING')
+    cards = reader.read_cards(itf_file)
+    outdir = tempfile.mkdtemp()
+    print('\t'.join(['setting', 'write_s', 'read_s', 'megabytes']))
+    try:
+        for label, codec, level, shuffle, fletcher32 in SETTINGS:
+            try:
+                filters = itf2hdf5.filter_options(
+                    codec, level, shuffle, fletcher32)
+            except ValueError as e:
+                print('\t'.join([label, 'skipped', str(e), '']))
+                continue
+            outfile = os.path.join(outdir, label + '.hdf5')
+            write_s = min(
+                _time_write(itf_file, outfile, cards, filters, jobs)
+                for _ in range(repeat))
+            read_s = min(_time_read(outfile) for _ in range(repeat))
+            print('\t'.join([
+                label,
+                '{:.3f}'.format(write_s),
+                '{:.3f}'.format(read_s),
+                '{:.2f}'.format(os.path.getsize(outfile) / 1.0e6),
+            ]))
+    finally:
+        shutil.rmtree(outdir)
+
+
+def _time_write(itf_file, outfile, cards, filters, jobs):
+    start = time.time()
+    itf2hdf5._save_data(
+        outfile,
+        reader.iter_blocks(itf_file),
+        cards,
+        reader.channel_map_from_string(
+            '1,0,2,3,4,5,6,7,8,9,10,11,12,13,14,15'),
+        True,
+        {},
+        jobs,
+        filters)
+    return time.time() - start
+
+
+def _time_read(outfile):
+    start = time.time()
+    with h5py.File(outfile, 'r') as h5f:
+        for ds in h5f['/channels'].values():
+            ds[:]
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    main()
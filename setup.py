@@ -49,6 +49,7 @@ setup(
             'itf2hdf5 = read_itek.itf2hdf5:main',
             'itek_hdf5_clip_stats = read_itek.itek_hdf5_clip_stats:main',
             'itf_clip_stats = read_itek.itf_clip_stats:main',
+            'itf_export = read_itek.itf_export:main',
         ]
     },
     classifiers=[
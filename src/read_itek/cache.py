@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Board of Regents of the University of Wisconsin System
+
+"""
+An on-disk cache of decoded .itf files, for reader.read_data():
+
+>>> cache = DecodeCache('/tmp/itek_cache', max_bytes=20 * 1024 ** 3)
+>>> data, cards = reader.read_data('data.itf', cache=cache)
+
+Entries are keyed by the file's path, size, modification time and a hash of
+its first and last HASH_BYTES (plus the channels decoded, if read_data() was
+given a subset, and whether it reconstructed long gaps), and hold the decoded
+INTERNAL_DTYPE array as .npy. The .ita cards aren't cached: they're small,
+and read_data() always reads them fresh. When the cache grows past
+max_bytes, the least recently used entries are removed.
+"""
+
+import os
+import hashlib
+import logging
+
+import numpy as np
+
+from read_itek.reader import write_atomically
+
+
+logger = logging.getLogger()
+
+HASH_BYTES = 1024 * 1024
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+
+class DecodeCache(object):
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, mmap=False):
+        # With mmap, cached data is memory-mapped instead of read
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mmap = mmap
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, itk_filename, channels=None, long_gaps=False):
+        stat = os.stat(itk_filename)
+        h = hashlib.sha1()
+        h.update(os.path.abspath(itk_filename).encode('utf-8'))
+        h.update('{0}:{1!r}'.format(stat.st_size, stat.st_mtime).encode())
+        if channels is not None:
+            h.update('channels:{}'.format(
+                ','.join(str(int(c)) for c in channels)).encode())
+        if long_gaps:
+            h.update(b'long_gaps')
+        with open(itk_filename, "rb") as f:
+            h.update(f.read(HASH_BYTES))
+            f.seek(max(stat.st_size - HASH_BYTES, 0))
+            h.update(f.read(HASH_BYTES))
+        return h.hexdigest()
+
+    def get(self, itk_filename, channels=None, long_gaps=False):
+        # Returns the decoded data for itk_filename, or None if it isn't
+        # cached
+        data_path = self._path(self.key(itk_filename, channels, long_gaps))
+        try:
+            data = np.load(data_path, mmap_mode='r' if self.mmap else None)
+        except (IOError, ValueError):
+            return None
+        logger.debug("Read {} from the cache".format(itk_filename))
+        # Bumping the modification time marks this as recently used
+        os.utime(data_path, None)
+        return data
+
+    def put(self, itk_filename, data, channels=None, long_gaps=False):
+        data_path = self._path(self.key(itk_filename, channels, long_gaps))
+        write_atomically(data_path, lambda f: np.save(f, data))
+        logger.debug("Cached {}".format(itk_filename))
+        self.evict()
+
+    def evict(self):
+        # Removes the least recently used entries until we fit in max_bytes
+        entries = {}
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if ext != '.npy':
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            entries[key] = (stat.st_size, stat.st_mtime)
+        total = sum(size for size, _ in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k][1]):
+            if total <= self.max_bytes:
+                break
+            logger.debug("Evicting {} from the cache".format(key))
+            path = self._path(key)
+            if os.path.exists(path):
+                os.remove(path)
+            total -= entries[key][0]
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if os.path.splitext(name)[1] == '.npy':
+                os.remove(os.path.join(self.directory, name))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
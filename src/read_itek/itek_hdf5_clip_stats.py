@@ -14,12 +14,17 @@ Options:
   --channels=<channels>    A comma-separated list of channel names, or 'all'
                            Examples: 'channel_012,channel_013', 'zygo,corr'
                            [default: all]
+  --jobs=<n>               Process this many files at once. Rows are still
+                           written in the order the files are listed.
+                           [default: 1]
 
 """
 
 import sys
 import csv
 import logging
+import functools
+import multiprocessing
 
 import h5py
 import numpy as np
@@ -42,36 +47,73 @@ HEADER = [
 ]
 
 
-def main():
-    args = docopt(__doc__, version="read_itek {}".format(VERSION))
+def main(argv=None):
+    args = docopt(__doc__, version="read_itek {}".format(VERSION), argv=argv)
     if args['--verbose']:
         logger.setLevel(logging.DEBUG)
     logger.debug(args)
     writer = csv.writer(sys.stdout, delimiter='\t')
     writer.writerow(HEADER)
-    for filename in args['<hdf5_file>']:
-        try:
-            report_clip_stats(filename, writer, args['--channels'])
-        except (IOError, KeyError) as e:
-            writer.writerow([filename, 'error', e.message, ''])
+    file_stats = functools.partial(
+        file_clip_stats, channel_names_str=args['--channels'])
+    jobs = int(args['--jobs'])
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(file_stats, args['<hdf5_file>'])
+    else:
+        results = (file_stats(f) for f in args['<hdf5_file>'])
+    for rows in results:
+        writer.writerows(rows)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def file_clip_stats(filename, channel_names_str):
+    # The rows to report for filename, or an error row if it can't be read
+    try:
+        return clip_stats_rows(filename, channel_names_str)
+    except (IOError, KeyError) as e:
+        return [[filename, 'error', str(e), '']]
 
 
 def report_clip_stats(filename, writer, channel_names_str):
-    f = h5py.File(filename, 'r')
-    channel_group = f['/channels']
-    keys = channel_keys(channel_names_str, channel_group)
-    for channel_name in keys:
-        dset = channel_group[channel_name]
-        clip_high = (dset[:] >= reader.VAL_MAX)
-        clip_low = (dset[:] <= reader.VAL_MIN)
-        clip_total = np.logical_or(clip_high, clip_low)
-        writer.writerow([
-            filename,
-            channel_name,
-            '{:.2f}%'.format(np.mean(clip_total) * 100),
-            '{:.2f}%'.format(np.mean(clip_low) * 100),
-            '{:.2f}%'.format(np.mean(clip_high) * 100),
-        ])
+    writer.writerows(clip_stats_rows(filename, channel_names_str))
+
+
+def clip_stats_rows(filename, channel_names_str):
+    rows = []
+    with h5py.File(filename, 'r') as f:
+        channel_group = f['/channels']
+        keys = channel_keys(channel_names_str, channel_group)
+        for channel_name in keys:
+            dset = channel_group[channel_name]
+            clip_low, clip_high = stored_clip_counts(dset)
+            # Like np.mean(), this gives nan for an empty channel
+            samples = np.float64(dset.shape[0])
+            rows.append([
+                filename,
+                channel_name,
+                '{:.2f}%'.format((clip_low + clip_high) / samples * 100),
+                '{:.2f}%'.format(clip_low / samples * 100),
+                '{:.2f}%'.format(clip_high / samples * 100),
+            ])
+    return rows
+
+
+def stored_clip_counts(dset):
+    # Returns (low, high) clip counts. Files from itf2hdf5 have them in the
+    # channel's attributes; otherwise, we count them a chunk at a time.
+    attrs = dset.attrs
+    if 'clip_low_count' in attrs and attrs.get('samples') == dset.shape[0]:
+        logger.debug('Using stored clip counts for {}'.format(dset.name))
+        return int(attrs['clip_low_count']), int(attrs['clip_high_count'])
+    clip_low, clip_high = 0, 0
+    for values in reader.iter_stored_channel(dset):
+        clip_low += np.count_nonzero(values <= reader.VAL_MIN)
+        clip_high += np.count_nonzero(values >= reader.VAL_MAX)
+    return clip_low, clip_high
 
 
 def channel_keys(channel_names_str, channels_group):
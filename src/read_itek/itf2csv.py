@@ -12,7 +12,10 @@ with one channel per row, followed by parallel port data. If a corresponding
 Made to mirror, as closely as possible, the behavor of docs/readitf.c
 
 Options:
-  -v, --verbose  Display debugging output
+  --precision=<digits>  Write scaled samples with this many significant
+                        digits, instead of as many as it takes to
+                        represent them exactly
+  -v, --verbose         Display debugging output
 """
 
 import sys
@@ -33,15 +36,25 @@ def main(argv=None):
         logger.setLevel(logging.DEBUG)
         reader.logger.setLevel(logging.DEBUG)
     logger.debug(args)
+    precision = None
+    if args['--precision'] is not None:
+        precision = int(args['--precision'])
     data, cards = reader.read_data(args['<data_file>'])
     outstream = sys.stdout
     if args['<output_file>']:
         outstream = open(args['<output_file>'], 'w')
-    write_data(data, cards, outstream)
+    write_data(data, cards, outstream, precision)
 
 
-def write_data(data, cards, outstream):
+# Rows are formatted and written this many values at a time
+CSV_CHUNK_SAMPLES = 65536
+
+
+def write_data(data, cards, outstream, precision=None):
     logger.debug(cards)
+    float_format = None
+    if precision is not None:
+        float_format = '%.{}g'.format(precision)
     for i, ch in enumerate(data['channels'].T):
         # This is incorrect! I'm leaving this here to emulate old behavior.
         # You really want reader.card_for_channel(cards, i)
@@ -49,8 +62,28 @@ def write_data(data, cards, outstream):
         card = cards[i // len(cards)]
         scale_factor = reader.scale_factor(card['gain'])
         scaled = ch * scale_factor
-        outstream.write(",".join(str(v) for v in scaled) + "\n")
-    outstream.write(",".join(str(v) for v in data['parallel_port']) + "\n")
+        write_row(outstream, scaled, float_format)
+    write_row(outstream, data['parallel_port'])
+
+
+def write_row(outstream, values, value_format=None):
+    """
+    Writes values as one comma-separated line, CSV_CHUNK_SAMPLES at a time.
+    With a value_format like '%.6g', each chunk is formatted in one go;
+    otherwise values are written as str() would write them.
+    """
+    for start in range(0, len(values), CSV_CHUNK_SAMPLES):
+        # tolist() gives us Python numbers, which format much faster than
+        # numpy scalars
+        chunk = values[start:start + CSV_CHUNK_SAMPLES].tolist()
+        if start > 0:
+            outstream.write(",")
+        if value_format is None:
+            outstream.write(",".join(map(str, chunk)))
+        else:
+            outstream.write(
+                ",".join([value_format] * len(chunk)) % tuple(chunk))
+    outstream.write("\n")
 
 
 if __name__ == '__main__':
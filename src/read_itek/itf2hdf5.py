@@ -16,6 +16,24 @@ Options:
                          off
   --channel_names=<str>  Use a string of the format num1:name,num2:name,...
                          to name the channels.
+  --jobs=<n>             Compress channel data with this many threads
+                         [default: 1]
+  --compression=<codec>  Compression for every dataset: none, lzf, gzip,
+                         or (if hdf5plugin is installed) blosc or zstd
+                         [default: gzip]
+  --level=<n>            Compression level for gzip, blosc and zstd
+                         [default: 4]
+  --shuffle              Apply the shuffle filter before compressing
+  --fletcher32           Store a checksum with every chunk
+  --chunk_size=<n>       Samples per stored chunk [default: 16384]
+  --matrix               Store all channels in /channels_matrix (see below)
+  --storage=<mode>       How to store channel samples: int32, packed24 or
+                         delta (see below) [default: int32]
+  --pyramid              Also store min/max/mean overviews of each channel
+                         in /pyramid (see below)
+  --long_gaps            Use the size of corrupt regions to work out how
+                         many samples long dropouts lost, instead of
+                         assuming each lost fewer than 256
 
 The output file layout looks like:
 
@@ -24,9 +42,26 @@ The output file layout looks like:
   gain:         The gain, as read from the .ita file
   lpf:          The lowpass filter cutoff, as read from the .ita file
   on:           Whether the channel is on or not, as read from the .ita file
+  samples, min, max, mean, rms, clip_low_count, clip_high_count:
+                Summary statistics, computed while converting. Like the
+                data, they count missing samples as 0.
 
 /channels/NAME:         An alias for one of the numbered channels.
 
+/channels_matrix:       With --matrix, every saved channel is stored here
+                        instead, as a samples x channels array chunked along
+                        time. /channels/channel_XXX are then virtual
+                        datasets, each reading one column.
+  channel_numbers: The channel number of each column.
+  scale_factor, gain, lpf, on: Arrays with the value for each column.
+
+/pyramid/level_N/channel_XXX:
+                        With --pyramid, the min, max and mean of each run of
+                        N samples of a channel, for N = 16, 256 and 4096.
+                        reader.overview() picks the right level to draw a
+                        stretch of time. Channel names are linked here too.
+  factor:       N
+
 /parallel_port:         Parallel port data. 1 unsigned byte / sample.
 
 /is_missing:            True if this frame is missing (as determied by the
@@ -45,15 +80,35 @@ The output file layout looks like:
 In addition, the root group has the following attributes:
   samples_per_second:   The sampling rate of the file. Always 1000 / 2.048.
   read_itek_version:    The version of read_itek that made this .hdf5 file.
+  missing_samples:      How many samples are missing.
+
+With --storage=packed24, channel datasets hold the three bytes of each 24-bit
+sample, little-endian, as an extra dimension of size 3. With --storage=delta,
+they hold the difference between each sample and the one before it (the first
+sample is stored as-is); this compresses best with --shuffle. Either way, the
+dataset gets a storage attribute, and reader.read_stored_channel() turns it
+back into signed 32-bit integers.
+
+reader.Hdf5Data reads these files a chunk at a time, giving channels by number
+or name, scaled to microvolts.
 
 If the .itf.ita file is missing, all channel attributes are set to 'unknown'
 except for scale_factor, which is set to 1.0.
 """
 
 import sys
+import zlib
 import logging
+import functools
+from multiprocessing.pool import ThreadPool
 
 import h5py
+import numpy as np
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
 from read_itek import reader
 from read_itek.vendor.docopt import docopt
@@ -71,88 +126,481 @@ def main(argv=None):
         reader.logger.setLevel(logging.DEBUG)
     logger.debug(args)
 
-    data, cards = reader.read_data(args['<itf_file>'])
+    cards = reader.read_cards(args['<itf_file>'])
     channel_map = reader.channel_map(
         [int(v) for v in args['--card_map'].split(',')])
     channel_name_str = args.get('--channel_names', '')
     try:
-        channel_names = channel_name_mapping(channel_name_str)
+        channel_names = reader.channel_name_mapping(channel_name_str)
     except ValueError:
         logger.error("Didn't understand channel_names {}".format(
             channel_name_str))
         sys.exit(1)
+    try:
+        filters = filter_options(
+            args['--compression'],
+            int(args['--level']),
+            args['--shuffle'],
+            args['--fletcher32'])
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    chunk_samples = int(args['--chunk_size'])
+    if args['--storage'] not in reader.STORAGE_MODES:
+        logger.error("Unknown storage {}; use one of {}".format(
+            args['--storage'], ', '.join(reader.STORAGE_MODES)))
+        sys.exit(1)
+    # Only decode the channels we're going to save
+    saved_channel_numbers = [
+        i for i, _ in _saved_channels(cards, channel_map, args['--all'])]
     _save_data(
         args['<hdf5_file>'],
-        data,
+        reader.iter_blocks(
+            args['<itf_file>'],
+            block_size=block_samples(chunk_samples),
+            channels=saved_channel_numbers,
+            long_gaps=args['--long_gaps']),
         cards,
         channel_map,
         args['--all'],
-        channel_names)
+        channel_names,
+        int(args['--jobs']),
+        filters,
+        chunk_samples,
+        args['--matrix'],
+        args['--storage'],
+        args['--pyramid'])
+
+
+# Datasets are written a block at a time, and stored in chunks of this many
+# samples by default.
+CHUNK_SAMPLES = 16384
+
+# h5py's default level for compression='gzip'
+GZIP_LEVEL = 4
+
+CODECS = ['none', 'lzf', 'gzip', 'blosc', 'zstd']
+
+FIELD_DATASETS = [
+    'parallel_port',
+    'error_flags',
+    'status_flags',
+    'tr_register',
+    'is_missing',
+]
+
+
+def filter_options(codec, level=GZIP_LEVEL, shuffle=False, fletcher32=False):
+    """
+    Returns the create_dataset() keyword arguments for a compression codec
+    and filters. Raises ValueError for codecs we don't know or can't use.
+    """
+    filters = {'fletcher32': fletcher32}
+    if codec == 'lzf':
+        filters['compression'] = 'lzf'
+    elif codec == 'gzip':
+        filters['compression'] = 'gzip'
+        filters['compression_opts'] = level
+    elif codec in ('blosc', 'zstd'):
+        if hdf5plugin is None:
+            raise ValueError(
+                "Compressing with {} needs the hdf5plugin package".format(
+                    codec))
+        if codec == 'blosc':
+            # blosc does its own shuffling
+            filters.update(hdf5plugin.Blosc(
+                cname='zstd',
+                clevel=level,
+                shuffle=(
+                    hdf5plugin.Blosc.SHUFFLE if shuffle
+                    else hdf5plugin.Blosc.NOSHUFFLE)))
+            shuffle = False
+        else:
+            filters.update(hdf5plugin.Zstd(clevel=level))
+    elif codec != 'none':
+        raise ValueError("Unknown compression {}; use one of {}".format(
+            codec, ', '.join(CODECS)))
+    filters['shuffle'] = shuffle
+    return filters
+
+
+def block_samples(chunk_samples):
+    # The block size to read with: a multiple of chunk_samples, so every
+    # block but the last fills whole chunks.
+    return chunk_samples * max(1, reader.BLOCK_SAMPLES // chunk_samples)
 
 
 def _save_data(
-        outfile, data, cards, channel_map, save_all_channels, channel_names):
+        outfile,
+        blocks,
+        cards,
+        channel_map,
+        save_all_channels,
+        channel_names,
+        jobs=1,
+        filters=None,
+        chunk_samples=CHUNK_SAMPLES,
+        matrix=False,
+        storage='int32',
+        pyramid=False):
     logger.debug('Saving to {}'.format(outfile))
+    if filters is None:
+        filters = filter_options('gzip')
     h5f = h5py.File(outfile, 'w')
     h5f.attrs['samples_per_second'] = reader.SAMPLES_PER_SECOND
     h5f.attrs['read_itek_version'] = VERSION
 
-    h5f.create_dataset(
-        'parallel_port', data=data['parallel_port'], compression='gzip')
-    h5f.create_dataset(
-        'error_flags', data=data['error_flags'], compression='gzip')
-    h5f.create_dataset(
-        'status_flags', data=data['status_flags'], compression='gzip')
-    h5f.create_dataset(
-        'tr_register', data=data['tr_register'], compression='gzip')
-    h5f.create_dataset(
-        'is_missing', data=data['is_missing'], compression='gzip')
-
-    _save_channels(
-        h5f,
-        data['channels'],
-        cards,
-        channel_map,
-        save_all_channels,
-        channel_names)
+    field_datasets = [
+        (name, _create_appendable(
+            h5f, name, reader.INTERNAL_DTYPE[name], filters, chunk_samples))
+        for name in FIELD_DATASETS]
+    saved_channels = _saved_channels(cards, channel_map, save_all_channels)
+    channel_numbers = [i for i, _ in saved_channels]
+    channel_datasets = []
+    matrix_ds = None
+    # With no channels to save there's nothing to put in a matrix, so we
+    # write the (empty) per-channel layout instead
+    if matrix and saved_channels:
+        matrix_ds = _create_matrix(
+            h5f, saved_channels, filters, chunk_samples, storage)
+    else:
+        channel_datasets = _create_channels(
+            h5f,
+            saved_channels,
+            channel_names,
+            filters,
+            chunk_samples,
+            storage)
+
+    pool = None
+    if jobs > 1 and not _can_write_direct(filters):
+        logger.warning(
+            "Can't compress in parallel with these filters; using 1 job")
+    elif jobs > 1:
+        logger.debug('Compressing with {} threads'.format(jobs))
+        pool = ThreadPool(jobs)
+    pyramid_levels = []
+    if pyramid:
+        pyramid_levels = _create_pyramid(
+            h5f, saved_channels, channel_names, filters, chunk_samples)
+
+    previous = None
+    summary = _new_summary(len(saved_channels))
+    for block in blocks:
+        for name, ds in field_datasets:
+            _append(ds, block[name])
+        channels = block['channels']
+        if channels.shape[1] != len(channel_numbers):
+            # These blocks have every channel, not just the ones we save
+            channels = channels[:, channel_numbers]
+        _update_summary(summary, channels, block['is_missing'])
+        for level in pyramid_levels:
+            _append_pyramid(level, channels)
+        stored = reader.encode_channels(channels, storage, previous)
+        previous = channels[-1]
+        if matrix_ds is not None:
+            _append_matrix(pool, matrix_ds, stored, filters)
+        else:
+            # Making the channel axis first puts each channel's samples
+            # together
+            stored = np.ascontiguousarray(np.swapaxes(stored, 0, 1))
+            _append_channels(pool, channel_datasets, stored, filters)
+    if pool is not None:
+        pool.close()
+    for level in pyramid_levels:
+        _append_pyramid(level, None)
+    if matrix_ds is not None:
+        channel_datasets = _link_matrix_channels(
+            h5f, matrix_ds, saved_channels, channel_names)
+    _save_summary(h5f, channel_datasets, summary)
     h5f.close()
 
 
-def channel_name_mapping(name_str):
-    """
-    Turns a string like '1:foo,2:bar' into the dict
-    {1: 'foo', 2: 'bar'}
-    May raise an exception if the string doens't follow this format.
-    Returns {} for an empty string.
-    """
-    mapping_strs = str(name_str).split(',')
-    str_pairs = [m.split(':') for m in mapping_strs]
-    pairs = [
-        [int(p[0]), p[1]] for p in str_pairs
-        if len(p) == 2]
-    return dict(pairs)
+def _create_pyramid(
+        h5f, saved_channels, channel_names, filters, chunk_samples):
+    # Returns a dict for each level, holding its factor, its datasets (one
+    # per saved channel), and the samples left over from the last block that
+    # don't fill a bin yet.
+    levels = []
+    pg = h5f.create_group('/pyramid')
+    for factor in reader.PYRAMID_FACTORS:
+        lg = pg.create_group('level_{}'.format(factor))
+        lg.attrs['factor'] = factor
+        datasets = []
+        for i, card in saved_channels:
+            ds = _create_appendable(
+                lg, _channel_label(i), reader.PYRAMID_DTYPE, filters,
+                chunk_samples)
+            channel_name = channel_names.get(i)
+            if channel_name:
+                lg[channel_name] = ds
+            datasets.append(ds)
+        levels.append({
+            'factor': factor,
+            'datasets': datasets,
+            'pending': np.zeros(
+                (0, len(saved_channels)),
+                dtype=reader.INTERNAL_DTYPE['channels'].base),
+        })
+    return levels
 
 
-def _save_channels(
-        h5f,
-        channels,
-        cards,
-        channel_map,
-        save_all_channels,
-        channel_names):
-    cg = h5f.create_group('/channels')
-    for i, ch in enumerate(channels.T):
+def _append_pyramid(level, channels):
+    # Adds the bins that channels completes to a level. Pass None at the end
+    # to write the last, partial bin.
+    factor = level['factor']
+    if channels is None:
+        values, level['pending'] = level['pending'], level['pending'][:0]
+    else:
+        values = np.concatenate([level['pending'], channels])
+        full = (len(values) // factor) * factor
+        values, level['pending'] = values[:full], values[full:]
+    if len(values) == 0:
+        return
+    bins = reader.pyramid_bins(values, factor)
+    for column, ds in enumerate(level['datasets']):
+        _append(ds, bins[:, column])
+
+
+def _new_summary(channel_count):
+    return {
+        'samples': 0,
+        'missing_samples': 0,
+        'clip_low_count': np.zeros(channel_count, dtype=np.int64),
+        'clip_high_count': np.zeros(channel_count, dtype=np.int64),
+        'min': np.full(channel_count, reader.VAL_MAX, dtype=np.int64),
+        'max': np.full(channel_count, reader.VAL_MIN, dtype=np.int64),
+        'sum': np.zeros(channel_count, dtype=np.int64),
+        'sum_squares': np.zeros(channel_count, dtype=np.float64),
+    }
+
+
+def _update_summary(summary, channels, is_missing):
+    # Missing samples count as 0, just as they're stored
+    summary['samples'] += len(channels)
+    summary['missing_samples'] += int(np.count_nonzero(is_missing))
+    summary['clip_low_count'] += np.count_nonzero(
+        channels <= reader.VAL_MIN, axis=0)
+    summary['clip_high_count'] += np.count_nonzero(
+        channels >= reader.VAL_MAX, axis=0)
+    if len(channels) > 0:
+        np.minimum(
+            summary['min'], channels.min(axis=0), out=summary['min'])
+        np.maximum(
+            summary['max'], channels.max(axis=0), out=summary['max'])
+    summary['sum'] += channels.sum(axis=0, dtype=np.int64)
+    summary['sum_squares'] += np.square(channels, dtype=np.float64).sum(0)
+
+
+def _save_summary(h5f, channel_datasets, summary):
+    samples = summary['samples']
+    h5f.attrs['missing_samples'] = summary['missing_samples']
+    for column, (i, ds) in enumerate(channel_datasets):
+        ds.attrs['samples'] = samples
+        ds.attrs['clip_low_count'] = summary['clip_low_count'][column]
+        ds.attrs['clip_high_count'] = summary['clip_high_count'][column]
+        if samples > 0:
+            ds.attrs['min'] = summary['min'][column]
+            ds.attrs['max'] = summary['max'][column]
+            ds.attrs['mean'] = summary['sum'][column] / float(samples)
+            ds.attrs['rms'] = np.sqrt(
+                summary['sum_squares'][column] / samples)
+
+
+def _create_appendable(group, name, dtype, filters, chunk_samples):
+    # An empty dataset that grows along its first axis. Subarray dtypes (like
+    # tr_register's) become extra dimensions.
+    item_shape = dtype.shape
+    return group.create_dataset(
+        name,
+        shape=(0,) + item_shape,
+        maxshape=(None,) + item_shape,
+        chunks=(chunk_samples,) + item_shape,
+        dtype=dtype.base,
+        **filters)
+
+
+def _append(ds, values):
+    start = ds.shape[0]
+    ds.resize(start + len(values), axis=0)
+    ds[start:] = values
+
+
+def _can_write_direct(filters):
+    # We only build chunks ourselves for the filters we can reproduce exactly
+    return (
+        filters.get('compression') in (None, 'gzip') and
+        not filters.get('fletcher32'))
+
+
+def _append_channels(pool, channel_datasets, channels, filters):
+    # channels has a row for each of channel_datasets. Without a pool, writes
+    # each channel through h5py. With one, encodes every channel's chunks in
+    # the pool, then hands them to HDF5 with direct chunk writes. HDF5 itself
+    # is only touched from this thread.
+    if pool is None or not channel_datasets:
+        for (i, ds), values in zip(channel_datasets, channels):
+            _append(ds, values)
+        return
+    chunk_samples = channel_datasets[0][1].chunks[0]
+    encoded = pool.map(
+        functools.partial(
+            _encode_chunks, chunk_samples=chunk_samples, filters=filters),
+        list(channels))
+    for (i, ds), chunks in zip(channel_datasets, encoded):
+        _write_chunks(ds, chunks, channels.shape[1])
+
+
+def _append_matrix(pool, ds, values, filters):
+    # Like _append_channels(), but the pool encodes the chunks of a single
+    # 2D dataset.
+    if pool is None:
+        _append(ds, values)
+        return
+    chunk_samples = ds.chunks[0]
+    pieces = [
+        values[start:start + chunk_samples]
+        for start in range(0, len(values), chunk_samples)]
+    encoded = pool.map(
+        functools.partial(
+            _encode_chunks, chunk_samples=chunk_samples, filters=filters),
+        pieces)
+    _write_chunks(ds, [c for chunks in encoded for c in chunks], len(values))
+
+
+def _write_chunks(ds, chunks, length):
+    start = ds.shape[0]
+    chunk_samples = ds.chunks[0]
+    ds.resize(start + length, axis=0)
+    other_axes = (0,) * (ds.ndim - 1)
+    for chunk_num, chunk in enumerate(chunks):
+        ds.id.write_direct_chunk(
+            (start + chunk_num * chunk_samples,) + other_axes, chunk)
+
+
+def _encode_chunks(values, chunk_samples, filters):
+    # Returns values as a list of chunks, filtered just as HDF5 would store
+    # them. A partial last chunk is padded out with zeros.
+    chunks = []
+    for start in range(0, len(values), chunk_samples):
+        chunk = np.zeros(
+            (chunk_samples,) + values.shape[1:], dtype=values.dtype)
+        piece = values[start:start + chunk_samples]
+        chunk[:len(piece)] = piece
+        chunk_bytes = chunk.view(np.uint8)
+        if filters.get('shuffle'):
+            chunk_bytes = chunk_bytes.reshape(-1, chunk.itemsize).T
+        chunk_bytes = chunk_bytes.tobytes()
+        if filters.get('compression') == 'gzip':
+            chunk_bytes = zlib.compress(
+                chunk_bytes, filters.get('compression_opts', GZIP_LEVEL))
+        chunks.append(chunk_bytes)
+    return chunks
+
+
+def _saved_channels(cards, channel_map, save_all_channels):
+    # Returns (channel_number, card) for each channel we're saving
+    saved_channels = []
+    for i in range(reader.CHANNELS):
         card = reader.card_for_channel(cards, i, channel_map)
         if card['on'] or save_all_channels:
-            channel_label = 'channel_{:03d}'.format(i)
-            ds = cg.create_dataset(channel_label, data=ch, compression='gzip')
-            for key, val in card.items():
-                ds.attrs[key] = val
-            channel_name = channel_names.get(i)
-            if channel_name:
-                logger.debug('Linking {} to {}'.format(
-                    channel_name, channel_label))
-                cg[channel_name] = ds
+            saved_channels.append((i, card))
+    return saved_channels
+
+
+def _create_channels(
+        h5f,
+        saved_channels,
+        channel_names,
+        filters,
+        chunk_samples,
+        storage):
+    # Returns a list of (channel_number, dataset) pairs
+    channel_datasets = []
+    cg = h5f.create_group('/channels')
+    for i, card in saved_channels:
+        ds = _create_appendable(
+            cg,
+            _channel_label(i),
+            reader.stored_dtype(storage),
+            filters,
+            chunk_samples)
+        _describe_channel(cg, ds, i, card, channel_names)
+        _mark_storage(ds, storage)
+        channel_datasets.append((i, ds))
+    return channel_datasets
+
+
+def _channel_label(channel_number):
+    return 'channel_{:03d}'.format(channel_number)
+
+
+def _describe_channel(cg, ds, channel_number, card, channel_names):
+    # Sets a channel dataset's attributes, and links its alias, if any
+    for key, val in card.items():
+        ds.attrs[key] = val
+    channel_name = channel_names.get(channel_number)
+    if channel_name:
+        logger.debug('Linking {} to {}'.format(
+            channel_name, _channel_label(channel_number)))
+        cg[channel_name] = ds
+
+
+def _mark_storage(ds, storage):
+    # int32 datasets don't get a storage attribute, so they look just like
+    # the ones older versions wrote
+    if storage != 'int32':
+        ds.attrs['storage'] = storage
+
+
+def _create_matrix(h5f, saved_channels, filters, chunk_samples, storage):
+    # /channels_matrix holds every saved channel, one column each. The
+    # per-channel attributes become arrays with an entry per column.
+    channel_count = len(saved_channels)
+    dtype = reader.stored_dtype(storage)
+    ds = h5f.create_dataset(
+        'channels_matrix',
+        shape=(0, channel_count) + dtype.shape,
+        maxshape=(None, channel_count) + dtype.shape,
+        chunks=(chunk_samples, max(channel_count, 1)) + dtype.shape,
+        dtype=dtype.base,
+        **filters)
+    _mark_storage(ds, storage)
+    ds.attrs['channel_numbers'] = [i for i, _ in saved_channels]
+    if saved_channels:
+        for key in saved_channels[0][1]:
+            ds.attrs[key] = _attr_array(
+                [card[key] for _, card in saved_channels])
+    return ds
+
+
+def _attr_array(values):
+    # HDF5 attributes can't hold numpy's unicode strings; use bytes
+    values = np.array(values)
+    if values.dtype.kind == 'U':
+        values = values.astype('S')
+    return values
+
+
+def _link_matrix_channels(h5f, matrix_ds, saved_channels, channel_names):
+    # Makes /channels/channel_XXX a virtual dataset for each column of
+    # /channels_matrix, so code that reads per-channel datasets still works.
+    # Returns a list of (channel_number, dataset) pairs.
+    channel_datasets = []
+    cg = h5f.create_group('/channels')
+    source = h5py.VirtualSource(
+        '.', matrix_ds.name, shape=matrix_ds.shape, dtype=matrix_ds.dtype)
+    for column, (i, card) in enumerate(saved_channels):
+        layout = h5py.VirtualLayout(
+            shape=(matrix_ds.shape[0],) + matrix_ds.shape[2:],
+            dtype=matrix_ds.dtype)
+        layout[:] = source[:, column]
+        ds = cg.create_virtual_dataset(_channel_label(i), layout)
+        _describe_channel(cg, ds, i, card, channel_names)
+        if 'storage' in matrix_ds.attrs:
+            ds.attrs['storage'] = matrix_ds.attrs['storage']
+        channel_datasets.append((i, ds))
+    return channel_datasets
 
 
 if __name__ == '__main__':
@@ -17,11 +17,16 @@ Options:
   --card_map=<order>     Change the mapping of cards to channel blocks
                          (16 numbers separated by commas)
                          [default: 1,0,2,3,4,5,6,7,8,9,10,11,12,13,14,15]
+  --jobs=<n>             Process this many files at once. Rows are still
+                         written in the order the files are listed.
+                         [default: 1]
 """
 
 import sys
 import csv
 import logging
+import functools
+import multiprocessing
 
 import numpy as np
 
@@ -51,29 +56,55 @@ def main(argv=None):
     writer = csv.writer(sys.stdout, delimiter='\t')
     writer.writerow(HEADER)
     channel_map = reader.channel_map_from_string(args['--card_map'])
-    channels = args['--channels']
-    for filename in args['<hdf5_file>']:
-        try:
-            report_clip_stats(filename, writer, channels, channel_map)
-        except (IOError, KeyError) as e:
-            writer.writerow([filename, 'error', e.message, ''])
+    file_stats = functools.partial(
+        file_clip_stats,
+        channels_str=args['--channels'],
+        channel_map=channel_map)
+    jobs = int(args['--jobs'])
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(file_stats, args['<hdf5_file>'])
+    else:
+        results = (file_stats(f) for f in args['<hdf5_file>'])
+    for rows in results:
+        writer.writerows(rows)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def file_clip_stats(filename, channels_str, channel_map):
+    # The rows to report for filename, or an error row if it can't be read
+    try:
+        return clip_stats_rows(filename, channels_str, channel_map)
+    except (IOError, KeyError) as e:
+        return [[filename, 'error', str(e), '']]
 
 
 def report_clip_stats(filename, writer, channels_str, channel_map):
-    itf_data, cards = reader.read_data(filename)
-    keys = channel_ids(channels_str, cards, channel_map)
-    for channel_number in keys:
-        dset = itf_data['channels'][:, channel_number]
-        clip_high = (dset[:] >= reader.VAL_MAX)
-        clip_low = (dset[:] <= reader.VAL_MIN)
-        clip_total = np.logical_or(clip_high, clip_low)
-        writer.writerow([
+    writer.writerows(clip_stats_rows(filename, channels_str, channel_map))
+
+
+def clip_stats_rows(filename, channels_str, channel_map):
+    with open(filename, "rb") as f:
+        cards = reader.read_cards(filename)
+        keys = list(channel_ids(channels_str, cards, channel_map))
+        samples, low_counts, high_counts = reader.count_clipped(f, keys)
+    # Like np.mean(), this gives nan for an empty file
+    low_fractions = low_counts / np.float64(samples)
+    high_fractions = high_counts / np.float64(samples)
+    return [
+        [
             filename,
             channel_number,
-            '{:.2f}%'.format(np.mean(clip_total) * 100),
-            '{:.2f}%'.format(np.mean(clip_low) * 100),
-            '{:.2f}%'.format(np.mean(clip_high) * 100),
-        ])
+            '{:.2f}%'.format((low + high) * 100),
+            '{:.2f}%'.format(low * 100),
+            '{:.2f}%'.format(high * 100),
+        ]
+        for channel_number, low, high in zip(
+            keys, low_fractions, high_fractions)
+    ]
 
 
 def channel_ids(channels_str, cards, channel_map):
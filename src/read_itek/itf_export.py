@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Board of Regents of the University of Wisconsin System
+
+"""Usage: itf_export [options] <itf_file> <output_file>
+
+Converts a .itf file, and its .itf.ita file if there is one, into something
+numpy, pandas or MATLAB can load directly: the saved channels scaled to
+microvolts, one column per channel, plus each sample's is_missing flag and
+parallel port data.
+
+Options:
+  -v --verbose           Show debugging output
+  --format=<fmt>         npy, npz, parquet or mat. By default, this comes
+                         from the extension of <output_file>.
+  --card_map=<order>     Change the mapping of cards to channel blocks
+                         (16 numbers separated by commas)
+                         [default: 1,0,2,3,4,5,6,7,8,9,10,11,12,13,14,15]
+  --all                  Export channels, even if the corresponding card is
+                         off
+  --channel_names=<str>  Use a string of the format num1:name,num2:name,...
+                         to name the channels.
+  --dtype=<type>         float32 or float64 [default: float32]
+  --long_gaps            Use the size of corrupt regions to work out how
+                         many samples long dropouts lost, instead of
+                         assuming each lost fewer than 256
+
+The formats:
+
+npy:      A samples x channels array. A JSON file next to it, named
+          <output_file>.json, holds channels (number, name, card, gain,
+          lpf, on and scale_factor for each column), samples_per_second and
+          read_itek_version. There's no is_missing or parallel_port data;
+          use npz for those.
+
+npz:      The samples x channels array is channels; is_missing and
+          parallel_port have a value per sample; channel_numbers,
+          channel_names, gain, lpf, on and scale_factor have a value per
+          column; and samples_per_second is a scalar. Load it with
+          numpy.load().
+
+parquet:  (if pyarrow is installed) A column per channel, named by its
+          channel name or channel_XXX, then is_missing and parallel_port.
+          Each channel column's metadata holds its number, card, gain, lpf
+          and scale_factor; the file's metadata holds samples_per_second
+          and read_itek_version.
+
+mat:      A MATLAB v7.3 file (if h5py is installed) with the same variables
+          as the npz file. In MATLAB, channels is samples x channels.
+
+Missing samples are 0. Gains and filters the .ita file doesn't give are NaN.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import zipfile
+import tempfile
+import contextlib
+from os import path
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from read_itek import reader
+from read_itek.vendor.docopt import docopt
+from read_itek import __version__ as VERSION
+
+logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+EXPORT_FORMATS = ['npy', 'npz', 'parquet', 'mat']
+
+# Exports read, scale and write this many samples at a time
+EXPORT_BLOCK_SAMPLES = reader.BLOCK_SAMPLES
+
+# MATLAB v7.3 files are HDF5 files with this much room at the front for a
+# MAT-file header
+MAT_USERBLOCK_BYTES = 512
+
+# ZipFile.open() can only write members from Python 3.6 on. Before that,
+# npz members go through a temporary file.
+ZIP_OPEN_WRITES = sys.version_info >= (3, 6)
+
+
+def main(argv=None):
+    args = docopt(__doc__, version='read_itek {}'.format(VERSION), argv=argv)
+    if args['--verbose']:
+        logger.setLevel(logging.DEBUG)
+        reader.logger.setLevel(logging.DEBUG)
+    logger.debug(args)
+
+    export_format = args['--format'] or export_format_for(
+        args['<output_file>'])
+    if export_format not in EXPORT_FORMATS:
+        logger.error("Unknown format {}; use one of {}".format(
+            export_format, ', '.join(EXPORT_FORMATS)))
+        sys.exit(1)
+    if args['--dtype'] not in ('float32', 'float64'):
+        logger.error("Unknown dtype {}; use float32 or float64".format(
+            args['--dtype']))
+        sys.exit(1)
+    channel_map = reader.channel_map(
+        [int(v) for v in args['--card_map'].split(',')])
+    channel_name_str = args.get('--channel_names') or ''
+    try:
+        channel_names = reader.channel_name_mapping(channel_name_str)
+    except ValueError:
+        logger.error("Didn't understand channel_names {}".format(
+            channel_name_str))
+        sys.exit(1)
+    try:
+        export(
+            args['<itf_file>'],
+            args['<output_file>'],
+            export_format,
+            channel_map,
+            args['--all'],
+            channel_names,
+            np.dtype(args['--dtype']),
+            args['--long_gaps'])
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+
+def export_format_for(filename):
+    # The format for an output file, from its extension
+    return path.splitext(filename)[1].lstrip('.').lower()
+
+
+def export(
+        itf_file,
+        outfile,
+        export_format,
+        channel_map,
+        export_all_channels=False,
+        channel_names=None,
+        dtype=np.float32,
+        long_gaps=False):
+    """
+    Writes itf_file's channels, scaled to microvolts, to outfile in
+    export_format, one of EXPORT_FORMATS. long_gaps works as it does for
+    reader.read_data(). Raises ValueError if we can't write that format.
+    """
+    writers = {
+        'npy': _write_npy,
+        'npz': _write_npz,
+        'parquet': _write_parquet,
+        'mat': _write_mat,
+    }
+    if export_format not in writers:
+        raise ValueError("Unknown format {}; use one of {}".format(
+            export_format, ', '.join(EXPORT_FORMATS)))
+    if export_format == 'parquet' and pyarrow is None:
+        raise ValueError("Exporting to parquet needs the pyarrow package")
+    if export_format == 'mat' and h5py is None:
+        raise ValueError("Exporting to mat needs the h5py package")
+    cards = reader.read_cards(itf_file)
+    if cards is None:
+        cards = reader.read_ita([])
+    channels = exported_channels(
+        cards, channel_map, export_all_channels, channel_names or {})
+    logger.debug('Exporting {} channels to {}'.format(
+        len(channels), outfile))
+    itf = reader.MappedItf(itf_file, long_gaps)
+    try:
+        writers[export_format](outfile, itf, channels, np.dtype(dtype))
+    finally:
+        itf.close()
+
+
+def exported_channels(cards, channel_map, export_all_channels, channel_names):
+    # A dict describing each channel we're exporting
+    channels = []
+    for i in range(reader.CHANNELS):
+        card_number = channel_map[i]
+        card = cards[card_number]
+        if not (card['on'] or export_all_channels):
+            continue
+        channels.append({
+            'number': i,
+            'name': channel_names.get(i, 'channel_{:03d}'.format(i)),
+            'card': int(card_number),
+            'gain': _number(card['gain']),
+            'lpf': _number(card['lpf']),
+            'on': card['on'] is not False,
+            'scale_factor': reader.card_scale_factor(card),
+        })
+    return channels
+
+
+def _number(val):
+    # .ita values that are missing are 'unknown'; make those NaN
+    if val == 'unknown':
+        return float('nan')
+    return float(val)
+
+
+def scaled_blocks(itf, channels, dtype, block_size=EXPORT_BLOCK_SAMPLES):
+    """
+    Yields (start, block, scaled) for each block_size samples of itf, a
+    reader.MappedItf, where block is the INTERNAL_DTYPE array holding just
+    the exported channels, and scaled is those channels in microvolts.
+    """
+    numbers = [c['number'] for c in channels]
+    scales = np.array([c['scale_factor'] for c in channels], dtype=dtype)
+    for start in range(0, len(itf), block_size):
+        block = itf.read(start, min(start + block_size, len(itf)), numbers)
+        scaled = block['channels'].astype(dtype)
+        scaled *= scales
+        yield start, block, scaled
+
+
+def _field_blocks(itf, name, block_size=EXPORT_BLOCK_SAMPLES):
+    # Yields blocks of one INTERNAL_DTYPE field, without decoding channels
+    for start in range(0, len(itf), block_size):
+        yield itf.read(start, min(start + block_size, len(itf)), [])[name]
+
+
+def _metadata_arrays(channels):
+    # The per-column and per-file variables for npz and mat exports
+    return [
+        ('channel_numbers', np.array(
+            [c['number'] for c in channels], dtype=np.float64)),
+        ('channel_names', np.array([c['name'] for c in channels])),
+        ('gain', np.array([c['gain'] for c in channels], dtype=np.float64)),
+        ('lpf', np.array([c['lpf'] for c in channels], dtype=np.float64)),
+        ('on', np.array([c['on'] for c in channels], dtype=bool)),
+        ('scale_factor', np.array(
+            [c['scale_factor'] for c in channels], dtype=np.float64)),
+        ('samples_per_second', np.array(reader.SAMPLES_PER_SECOND)),
+    ]
+
+
+def _write_npy(outfile, itf, channels, dtype):
+    out = np.lib.format.open_memmap(
+        outfile, mode='w+', dtype=dtype, shape=(len(itf), len(channels)))
+    for start, block, scaled in scaled_blocks(itf, channels, dtype):
+        out[start:start + len(block)] = scaled
+    out.flush()
+    del out
+    metadata = {
+        'channels': channels,
+        'samples_per_second': reader.SAMPLES_PER_SECOND,
+        'read_itek_version': VERSION,
+    }
+    with open(outfile + '.json', 'w') as f:
+        # NaN isn't valid JSON; write null instead
+        json.dump(_json_safe(metadata), f)
+
+
+def _json_safe(val):
+    if isinstance(val, dict):
+        return dict((k, _json_safe(v)) for k, v in val.items())
+    if isinstance(val, list):
+        return [_json_safe(v) for v in val]
+    if isinstance(val, float) and val != val:
+        return None
+    return val
+
+
+def _write_npz(outfile, itf, channels, dtype):
+    # np.savez() needs every array in memory, so we write the .npy members
+    # ourselves, a block at a time
+    with contextlib.closing(
+            zipfile.ZipFile(outfile, 'w', allowZip64=True)) as zf:
+        _write_npz_member(
+            zf,
+            'channels',
+            dtype,
+            (len(itf), len(channels)),
+            (scaled for _, _, scaled in scaled_blocks(itf, channels, dtype)))
+        for name in ('is_missing', 'parallel_port'):
+            _write_npz_member(
+                zf,
+                name,
+                reader.INTERNAL_DTYPE[name],
+                (len(itf),),
+                _field_blocks(itf, name))
+        for name, values in _metadata_arrays(channels):
+            with _npz_member(zf, name) as f:
+                np.lib.format.write_array(f, values)
+
+
+def _write_npz_member(zf, name, dtype, shape, blocks):
+    with _npz_member(zf, name) as f:
+        np.lib.format.write_array_header_1_0(f, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            'fortran_order': False,
+            'shape': shape,
+        })
+        for block in blocks:
+            f.write(np.ascontiguousarray(block, dtype=dtype).tobytes())
+
+
+@contextlib.contextmanager
+def _npz_member(zf, name):
+    # A file to write zf's name.npy member into
+    if ZIP_OPEN_WRITES:
+        with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+            yield f
+        return
+    fd, temp_path = tempfile.mkstemp(
+        suffix='.npy', dir=path.dirname(path.abspath(zf.filename)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        zf.write(temp_path, name + '.npy')
+    finally:
+        os.remove(temp_path)
+
+
+def _write_parquet(outfile, itf, channels, dtype):
+    fields = [
+        pyarrow.field(
+            c['name'],
+            pyarrow.from_numpy_dtype(dtype),
+            metadata=dict(
+                (key, json.dumps(_json_safe(c[key])))
+                for key in ('number', 'card', 'gain', 'lpf', 'scale_factor')))
+        for c in channels
+    ] + [
+        pyarrow.field('is_missing', pyarrow.bool_()),
+        pyarrow.field('parallel_port', pyarrow.uint8()),
+    ]
+    schema = pyarrow.schema(fields, metadata={
+        'samples_per_second': json.dumps(reader.SAMPLES_PER_SECOND),
+        'read_itek_version': VERSION,
+    })
+    writer = pyarrow.parquet.ParquetWriter(outfile, schema)
+    try:
+        # Each block becomes a row group
+        for _, block, scaled in scaled_blocks(itf, channels, dtype):
+            columns = [scaled[:, i] for i in range(len(channels))] + [
+                block['is_missing'], block['parallel_port']]
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(c) for c in columns], schema=schema))
+    finally:
+        writer.close()
+
+
+def _write_mat(outfile, itf, channels, dtype):
+    # MATLAB arrays are column-major, so HDF5 dimensions come out reversed:
+    # a (channels, samples) dataset is samples x channels in MATLAB.
+    h5f = h5py.File(outfile, 'w', userblock_size=MAT_USERBLOCK_BYTES)
+    try:
+        ds = h5f.create_dataset(
+            'channels', shape=(len(channels), len(itf)), dtype=dtype)
+        _mat_class(ds, 'single' if dtype == np.float32 else 'double')
+        fields = [
+            (name, h5f.create_dataset(
+                name, shape=(1, len(itf)), dtype=np.uint8))
+            for name in ('is_missing', 'parallel_port')]
+        _mat_class(fields[0][1], 'logical')
+        _mat_class(fields[1][1], 'uint8')
+        for start, block, scaled in scaled_blocks(itf, channels, dtype):
+            stop = start + len(block)
+            ds[:, start:stop] = scaled.T
+            for name, field_ds in fields:
+                field_ds[0, start:stop] = block[name]
+        for name, values in _metadata_arrays(channels):
+            _write_mat_variable(h5f, name, values)
+    finally:
+        h5f.close()
+    with open(outfile, 'r+b') as f:
+        f.write(_mat_header())
+
+
+def _write_mat_variable(h5f, name, values):
+    if values.dtype.kind == 'U':
+        # A char matrix, with a row per string
+        width = max([len(v) for v in values] + [1])
+        chars = np.zeros((width, len(values)), dtype=np.uint16)
+        for i, val in enumerate(values):
+            chars[:len(val), i] = [ord(c) for c in val]
+        _mat_class(h5f.create_dataset(name, data=chars), 'char')
+    elif values.dtype == bool:
+        _mat_class(
+            h5f.create_dataset(
+                name, data=values.astype(np.uint8).reshape(1, -1)),
+            'logical')
+    else:
+        _mat_class(
+            h5f.create_dataset(name, data=values.reshape(1, -1)), 'double')
+
+
+def _mat_class(ds, matlab_class):
+    ds.attrs['MATLAB_class'] = np.bytes_(matlab_class)
+    if matlab_class == 'logical':
+        ds.attrs['MATLAB_int_decode'] = np.int32(1)
+    elif matlab_class == 'char':
+        ds.attrs['MATLAB_int_decode'] = np.int32(2)
+
+
+def _mat_header():
+    # The text, subsystem offset, version and endian indicator that MATLAB
+    # expects at the start of a v7.3 file
+    text = 'MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: {} ' \
+        'HDF5 schema 1.00 .'.format(time.strftime('%a %b %d %H:%M:%S %Y'))
+    header = text.ljust(116).encode('ascii')
+    header += b'\x00' * 8 + b'\x00\x02' + b'IM'
+    return header.ljust(MAT_USERBLOCK_BYTES, b'\x00')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,15 @@
 # Copyright (c) 2017 Board of Regents of the University of Wisconsin System
 # Written by Nathan Vack <njvack@wisc.edu>
 
-from collections import defaultdict
+import os
+import re
+import zipfile
+import tempfile
+from collections import defaultdict, OrderedDict
 
 import numpy as np
 import logging
+
 logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -38,16 +43,24 @@ FRAME_DTYPE = np.dtype([
     ('frameTerminator', '2B')  # Should be [0x55 0xAA]
 ])
 
-INTERNAL_DTYPE = np.dtype([
-    ('error_flags', 'B'),
-    ('status_flags', 'B'),
-    ('parallel_port', 'B'),
-    ('tr_register', '2B'),
-    ('channels', '<i4', 128),
-    ('is_missing', '?')
-])
-
 CHANNELS = 128
+
+
+def internal_dtype(channel_count=CHANNELS):
+    # INTERNAL_DTYPE, but holding only channel_count channels; see the
+    # channels argument of read_data()
+    return np.dtype([
+        ('error_flags', 'B'),
+        ('status_flags', 'B'),
+        ('parallel_port', 'B'),
+        ('tr_register', '2B'),
+        ('channels', '<i4', (channel_count,)),
+        ('is_missing', '?')
+    ])
+
+
+INTERNAL_DTYPE = internal_dtype()
+
 CARDS = 16
 CHANNELS_PER_CARD = CHANNELS // CARDS
 
@@ -79,27 +92,402 @@ MICROV = 1.0e+06
 
 SAMPLES_PER_SECOND = 1000 / 2.048
 
+# How many frames frame_runs() checks at once. Bounds the scratch memory we
+# use when validating long runs of frames.
+CHECK_FRAMES = 65536
+
+# The default number of samples in each block from iter_blocks(), and how
+# many bytes it reads from the file at once.
+BLOCK_SAMPLES = 65536
+READ_BYTES = 4 * 1024 * 1024
+
+# The frame index for data.itf is saved in data.itf.idx
+INDEX_SUFFIX = '.idx'
+
+# How many bytes find_next_frame() searches at once.
+RESYNC_WINDOW = 65536
+
+
+def _field_offset(name):
+    return FRAME_DTYPE.fields[name][1]
+
+
+# (byte offset, value) pairs that must hold in every valid frame. packet1
+# comes first; find_next_frame() uses it to find candidate frame starts.
+MARKER_BYTES = [
+    (_field_offset('packet{0}'.format(i)), ord(str(i))) for i in range(1, 8)
+] + [
+    (_field_offset('frameTerminator'), 0x55),
+    (_field_offset('frameTerminator') + 1, 0xAA)
+]
+RECORD_NUMBER_OFFSET = _field_offset('recordNumber')
+SAME_RECORD_NUMBER_OFFSET = _field_offset('sameRecordNumber')
+
+# (field, first channel, channel after the last) for each block of channels
+# in a frame. Within a block, channels are stored in descending order.
+CHANNEL_BLOCKS = [
+    ('chans08to00', 0, 9),
+    ('chans28to09', 9, 29),
+    ('chans48to29', 29, 49),
+    ('chans68to49', 49, 69),
+    ('chans88to69', 69, 89),
+    ('chans108to89', 89, 109),
+    ('chans127to109', 109, 128),
+]
+
+
+def _channel_byte_offsets():
+    offsets = np.zeros(CHANNELS, dtype=np.intp)
+    for name, first, stop in CHANNEL_BLOCKS:
+        channels = np.arange(first, stop)
+        offsets[channels] = _field_offset(name) + 3 * (stop - 1 - channels)
+    return offsets
+
+
+# The offset of each channel's first (most significant) byte in a frame
+CHANNEL_OFFSETS = _channel_byte_offsets()
+
+# The big-endian bytes of VAL_MAX and VAL_MIN
+VAL_MAX_BYTES = [0x7F, 0xFF, 0xFF]
+VAL_MIN_BYTES = [0x80, 0x00, 0x00]
+
+# One bin of itf2hdf5's --pyramid overviews, and the number of samples each
+# level's bins cover
+PYRAMID_DTYPE = np.dtype([
+    ('min', '<i4'),
+    ('max', '<i4'),
+    ('mean', '<f8')
+])
+PYRAMID_FACTORS = [16, 256, 4096]
+
+# How itf2hdf5 can store channel samples; see encode_channels()
+STORAGE_MODES = ['int32', 'packed24', 'delta']
+
+# How fill_gaps() can fill in missing samples
+GAP_FILL_METHODS = ['hold', 'linear', 'nan']
+
+# recordNumber is one byte, so it wraps around every this many frames
+RECORD_COUNTER_WRAP = 256
+
+# With long_gaps, if the frames we think were lost across some skipped bytes
+# and the frames the skipped bytes could have held differ by more than this,
+# we call the gap ambiguous
+AMBIGUOUS_GAP_FRAMES = RECORD_COUNTER_WRAP // 4
+
+# How many decoded chunks an Hdf5Data keeps in memory, by default
+CACHE_CHUNKS = 64
+
+# How itf2hdf5 names channel datasets
+CHANNEL_LABEL_RE = re.compile(r'^channel_(\d{3})$')
+
 # Since we have 2's compliment signed 24-bit ints, this is their range
 VAL_MAX = (2 ** 23) - 1
 VAL_MIN = -(2 ** 23)
 
 
-def read_data(itk_filename):
+def read_data(
+        itk_filename,
+        cache=None,
+        channels=None,
+        channel_map=None,
+        long_gaps=False):
+    """
+    Reads and decodes itk_filename, returning (data, cards).
+
+    By default, data['channels'] holds all CHANNELS channels. To decode only
+    some of them, pass their numbers as channels; data['channels'][:, i] is
+    then channels[i]. Or pass a channel_map, and only the channels whose
+    cards are on in the .ita file are decoded -- that's
+    on_channels(cards, channel_map).
+
+    recordNumber is only one byte, so gaps of more than 255 frames normally
+    put every later sample at the wrong time. With long_gaps, the size of
+    each corrupt region is used to guess how many frames it lost; see
+    unwrap_record_numbers().
+
+    cache can be a read_itek.cache.DecodeCache, to keep decoded data between
+    calls.
+    """
+    cards = read_cards(itk_filename)
+    if channels is None and channel_map is not None:
+        if cards is None:
+            raise ValueError(
+                "Can't tell which channels are on without a .ita file")
+        channels = on_channels(cards, channel_map)
+    if cache is not None:
+        cached = cache.get(itk_filename, channels, long_gaps)
+        if cached is not None:
+            return (cached, cards)
     logger.debug('Reading {}'.format(itk_filename))
-    ita_filename = itk_filename + ".ita"
     frames = None
-    cards = None
     with open(itk_filename, "rb") as f:
-        frames = read_frames(f)
-    itk_data = convert_frames_to_internal_type(frames)
+        frames, report = read_frames_report(f)
+    offsets = None
+    if long_gaps:
+        offsets = run_frame_offsets(report['runs'])
+    itk_data = convert_frames_to_internal_type(frames, channels, offsets)
     logger.debug("{} frames are missing.".format(
         np.sum(itk_data['is_missing'])))
+    if cache is not None:
+        cache.put(itk_filename, itk_data, channels, long_gaps)
+    return (itk_data, cards)
+
+
+def map_data(itk_filename):
+    """
+    Like read_data(), but returns a MappedItf instead of decoding the whole
+    file into memory.
+    """
+    logger.debug('Mapping {}'.format(itk_filename))
+    return (MappedItf(itk_filename), read_cards(itk_filename))
+
+
+def read_cards(itk_filename):
+    # Reads the .ita file that goes with itk_filename. Returns None if it
+    # isn't there.
+    ita_filename = itk_filename + ".ita"
+    cards = None
     try:
         with open(ita_filename, "r") as f:
             cards = read_ita(f)
     except IOError:
         logger.warn("Could not read {}".format(ita_filename))
-    return (itk_data, cards)
+    return cards
+
+
+def index_filename(itk_filename):
+    return itk_filename + INDEX_SUFFIX
+
+
+def build_index(itk_filename, read_size=READ_BYTES):
+    """
+    Scans itk_filename once, and returns its frame index: a dict with the
+    byte offset and record number of every valid frame, plus the file's size
+    and modification time so we can tell when the index is out of date.
+    """
+    decoder = FrameDecoder()
+    offsets = []
+    rnums = []
+    with open(itk_filename, "rb") as f:
+        while True:
+            data = f.read(read_size)
+            if not data:
+                break
+            _, chunk_rnums, chunk_offsets = decoder.decode(data)
+            offsets.append(chunk_offsets)
+            rnums.append(chunk_rnums)
+    stat = os.stat(itk_filename)
+    return {
+        'offsets': np.concatenate(offsets + [np.zeros(0, dtype=np.int64)]),
+        'record_numbers': np.concatenate(
+            rnums + [np.zeros(0, dtype=np.int32)]),
+        'file_size': stat.st_size,
+        'file_mtime': stat.st_mtime,
+    }
+
+
+def save_index(itk_filename, index):
+    # Written atomically, so a reader never sees a half-written index
+    write_atomically(
+        index_filename(itk_filename),
+        lambda f: np.savez_compressed(f, **index))
+
+
+def write_atomically(path, write):
+    """
+    Calls write() with a file open for writing, and moves what it wrote to
+    path once it's done, so readers never see a partial file. The file gets
+    the permissions open() would have given it, not mkstemp()'s 0600.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0o666 & ~umask)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def load_index(itk_filename):
+    """
+    Returns the frame index for itk_filename, from its sidecar file if that
+    is up to date. Otherwise, builds the index and tries to save it.
+    """
+    stat = os.stat(itk_filename)
+    try:
+        with open(index_filename(itk_filename), "rb") as f:
+            stored = np.load(f)
+            index = dict((key, stored[key]) for key in stored.files)
+        if (index['file_size'] == stat.st_size and
+                index['file_mtime'] == stat.st_mtime):
+            return index
+        logger.debug("{} is out of date".format(
+            index_filename(itk_filename)))
+    except (IOError, KeyError, ValueError, EOFError, zipfile.BadZipfile):
+        # A damaged index is just as good as a stale one
+        logger.debug("Could not read {}".format(
+            index_filename(itk_filename)))
+    index = build_index(itk_filename)
+    try:
+        save_index(itk_filename, index)
+    except IOError:
+        logger.warn("Could not write {}".format(
+            index_filename(itk_filename)))
+    return index
+
+
+def read_samples(itk_filename, start, stop, index=None):
+    """
+    Reads samples start through stop of itk_filename into an INTERNAL_DTYPE
+    array, just like read_data()'s output[start:stop], but only reads the
+    frames in that range. Uses (and creates, if needed) the file's index.
+    """
+    if index is None:
+        index = load_index(itk_filename)
+    rnums = index['record_numbers']
+    first, last = np.searchsorted(rnums, [start, stop])
+    offsets = index['offsets'][first:last]
+    stop = min(stop, int(rnums[-1]) + 1 if len(rnums) else 0)
+    internal_struct = empty_internal_type(max(stop - start, 0))
+    # Read each run of back-to-back frames at once
+    run_starts = np.flatnonzero(
+        np.diff(offsets, prepend=-1) != FRAME_DTYPE.itemsize)
+    run_stops = np.append(run_starts[1:], len(offsets))
+    with open(itk_filename, "rb") as f:
+        for run_start, run_stop in zip(run_starts, run_stops):
+            f.seek(int(offsets[run_start]))
+            frames = np.fromfile(
+                f, dtype=FRAME_DTYPE, count=run_stop - run_start)
+            fill_internal_type(
+                internal_struct,
+                frames,
+                rnums[first + run_start:first + run_stop] - start)
+    return internal_struct
+
+
+def read_seconds(itk_filename, start, stop, index=None):
+    # Like read_samples(), but start and stop are in seconds
+    return read_samples(
+        itk_filename,
+        int(start * SAMPLES_PER_SECOND),
+        int(np.ceil(stop * SAMPLES_PER_SECOND)),
+        index)
+
+
+class MappedItf(object):
+    """
+    A .itf file, memory-mapped instead of read. Opening one finds the valid
+    frames and their record numbers, but channel data is only decoded when
+    you ask for a range of samples:
+
+    >>> itf = MappedItf('data.itf')
+    >>> samples = itf[1000:2000]  # An INTERNAL_DTYPE array
+
+    Sample numbers are the same as the rows of read_data()'s output.
+    """
+
+    def __init__(self, itk_filename, long_gaps=False):
+        self.filename = itk_filename
+        if os.path.getsize(itk_filename) == 0:
+            # mmap can't map an empty file, and there's nothing to map anyway
+            self.buf = np.zeros(0, dtype=np.uint8)
+        else:
+            self.buf = np.memmap(itk_filename, dtype=np.uint8, mode='r')
+        runs = list(frame_runs(self.buf))
+        self.run_offsets = np.array([r[0] for r in runs], dtype=np.int64)
+        self.run_counts = np.array([r[1] for r in runs], dtype=np.int64)
+        self.run_first_frames = np.cumsum(self.run_counts) - self.run_counts
+        self.frame_count = int(np.sum(self.run_counts))
+        # Strided views of each run's record counters, so we only hold one
+        # byte per frame
+        counter = np.concatenate([
+            self.buf[o + RECORD_NUMBER_OFFSET:o + c * FRAME_DTYPE.itemsize:
+                     FRAME_DTYPE.itemsize]
+            for o, c in runs] + [np.zeros(0, dtype=np.uint8)])
+        if long_gaps:
+            self.record_numbers = _reconstruct_record_numbers(
+                counter, self.frame_offsets())
+        else:
+            self.record_numbers = unwrap_record_numbers(counter)
+        logger.debug("Mapped {0} valid frames in {1} runs.".format(
+            self.frame_count, len(runs)))
+
+    def __len__(self):
+        if self.frame_count == 0:
+            return 0
+        return int(self.record_numbers[-1]) + 1
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("MappedItf only supports [start:stop] slicing")
+        start, stop, _ = key.indices(len(self))
+        return self.read(start, stop)
+
+    @property
+    def is_missing(self):
+        missing = np.ones(len(self), dtype=bool)
+        missing[self.record_numbers] = False
+        return missing
+
+    def frame_offsets(self, start=0, stop=None):
+        # The byte offsets of valid frames start through stop
+        if stop is None:
+            stop = self.frame_count
+        frames = np.arange(start, stop, dtype=np.int64)
+        runs = np.searchsorted(self.run_first_frames, frames, 'right') - 1
+        return (
+            self.run_offsets[runs] +
+            (frames - self.run_first_frames[runs]) * FRAME_DTYPE.itemsize)
+
+    def frames(self, start=0, stop=None):
+        """
+        Returns valid frames start through stop, as FRAME_DTYPE. If they're
+        all in one run, this is a view into the mapped file.
+        """
+        if self.buf is None:
+            raise ValueError("{} is closed".format(self.filename))
+        if stop is None:
+            stop = self.frame_count
+        pieces = []
+        frame = start
+        while frame < stop:
+            run = np.searchsorted(self.run_first_frames, frame, 'right') - 1
+            run_end = self.run_first_frames[run] + self.run_counts[run]
+            count = int(min(run_end, stop) - frame)
+            offset = int(self.run_offsets[run] + (
+                frame - self.run_first_frames[run]) * FRAME_DTYPE.itemsize)
+            pieces.append(frames_at(self.buf, offset, count))
+            frame += count
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces or [np.zeros(0, dtype=FRAME_DTYPE)])
+
+    def read(self, start=0, stop=None, channels=None):
+        """
+        Decodes samples start through stop into an INTERNAL_DTYPE array. As
+        with read_data(), channels selects which channels to decode.
+        """
+        if stop is None:
+            stop = len(self)
+        first, last = np.searchsorted(self.record_numbers, [start, stop])
+        channel_count = CHANNELS if channels is None else len(channels)
+        internal_struct = empty_internal_type(
+            max(stop - start, 0), channel_count)
+        fill_internal_type(
+            internal_struct,
+            self.frames(first, last),
+            self.record_numbers[first:last] - start,
+            channels)
+        return internal_struct
+
+    def close(self):
+        # Arrays from frames() may still be views into the mapping, so we
+        # let numpy unmap the file once the last of them is gone.
+        self.buf = None
 
 
 def open_file_size(infile):
@@ -111,18 +499,338 @@ def open_file_size(infile):
 
 
 def read_frames(infile):
-    total_bytes = open_file_size(infile)
-    max_possible_frames = total_bytes // FRAME_DTYPE.itemsize
-    frames = np.zeros(max_possible_frames, dtype=FRAME_DTYPE)
-    logger.debug("File size is {0} bytes, allocated {1} frames".format(
-        total_bytes, max_possible_frames))
+    # Returns exactly the valid frames in infile; see read_frames_report()
+    return read_frames_report(infile)[0]
+
+
+def read_frames_report(infile):
+    """
+    Reads the valid frames in infile. Returns (frames, report), where
+    frames holds only the valid frames, and report is a dict of:
+
+    total_bytes: the size of the file
+    valid_frames: len(frames)
+    rejected_bytes: how many bytes weren't part of a valid frame
+    rejected_frames: rejected_bytes in frames, rounded down
+    skipped_ranges: the (start, stop) byte ranges that were rejected
+    runs: the (byte offset, frame count) of each run of valid frames
+    """
     infile.seek(0)
-    max_index = 0
-    for frame_index, frame in enumerate(generate_valid_frames(infile)):
-        frames[frame_index] = frame
-        max_index = frame_index
-    logger.debug("Read {0} valid frames.".format(max_index))
-    return frames
+    buf = np.fromfile(infile, dtype=np.uint8)
+    runs = list(frame_runs(buf))
+    if len(runs) == 1:
+        # Nothing to stitch together, so we don't need to copy anything
+        frames = frames_at(buf, *runs[0])
+    else:
+        frames = np.concatenate(
+            [frames_at(buf, offset, count) for offset, count in runs] or
+            [np.zeros(0, dtype=FRAME_DTYPE)])
+    skipped = skipped_ranges(runs, len(buf))
+    rejected_bytes = sum(stop - start for start, stop in skipped)
+    report = {
+        'total_bytes': len(buf),
+        'valid_frames': len(frames),
+        'rejected_bytes': rejected_bytes,
+        'rejected_frames': rejected_bytes // FRAME_DTYPE.itemsize,
+        'skipped_ranges': skipped,
+        'runs': runs,
+    }
+    logger.debug("Read {0} valid frames.".format(len(frames)))
+    logger.debug(
+        "Rejected {0} bytes (about {1} frames) in {2} places.".format(
+            rejected_bytes, report['rejected_frames'], len(skipped)))
+    return frames, report
+
+
+def frames_at(buf, offset, count):
+    # A zero-copy view of count consecutive frames starting at offset in buf,
+    # which must be a uint8 array.
+    end = offset + count * FRAME_DTYPE.itemsize
+    return buf[offset:end].view(FRAME_DTYPE)
+
+
+def run_frame_offsets(runs):
+    # The byte offset of every frame in runs, from frame_runs()
+    return np.concatenate(
+        [o + np.arange(c, dtype=np.int64) * FRAME_DTYPE.itemsize
+         for o, c in runs] + [np.zeros(0, dtype=np.int64)])
+
+
+def good_frame_mask(frames):
+    # The vectorized version of is_good_frame(); works on an array of frames
+    terminator = frames['frameTerminator']
+    return (
+        (frames['recordNumber'] == frames['sameRecordNumber']) &
+        (frames['packet1'] == b'1') &
+        (frames['packet2'] == b'2') &
+        (frames['packet3'] == b'3') &
+        (frames['packet4'] == b'4') &
+        (frames['packet5'] == b'5') &
+        (frames['packet6'] == b'6') &
+        (frames['packet7'] == b'7') &
+        (terminator[:, 0] == 0x55) &
+        (terminator[:, 1] == 0xAA)
+    )
+
+
+def frame_runs(buf, start=0):
+    """
+    Find the valid frames in buf, a uint8 array holding .itf data.
+
+    Yields (byte_offset, frame_count) for each run of consecutive valid
+    frames. The frames found are exactly the ones generate_valid_frames()
+    would find: runs of well-formed frames are checked in bulk, and we only
+    fall back to find_next_frame() around corrupt regions.
+    """
+    frame_size = FRAME_DTYPE.itemsize
+    run_start, run_length = start, 0
+    pos = start
+    while len(buf) - pos >= frame_size:
+        count = min((len(buf) - pos) // frame_size, CHECK_FRAMES)
+        good = good_frame_mask(frames_at(buf, pos, count))
+        bad_indexes = np.flatnonzero(~good)
+        good_count = int(bad_indexes[0]) if len(bad_indexes) else count
+        run_length += good_count
+        pos += good_count * frame_size
+        if good_count == count:
+            continue
+        if run_length > 0:
+            yield run_start, run_length
+        bad_byte = pos
+        pos = find_next_frame(buf, pos + 1)
+        logger.debug("Skipped bytes {0} to {1}.".format(bad_byte, pos))
+        run_start, run_length = pos, 0
+    if run_length > 0:
+        yield run_start, run_length
+    logger.debug("Reached end of file.")
+
+
+def find_next_frame(buf, start):
+    """
+    Returns the offset of the first valid frame at or after start, or
+    len(buf) if there isn't one.
+
+    Rather than decoding a frame at every byte, we look for an ASCII '1'
+    with the rest of the packet markers and the terminator at their fixed
+    offsets, and check every candidate in a window at once.
+    """
+    frame_size = FRAME_DTYPE.itemsize
+    last_start = len(buf) - frame_size
+    window_start = start
+    while window_start <= last_start:
+        window_stop = min(window_start + RESYNC_WINDOW, last_start + 1)
+        candidates = window_start + np.flatnonzero(
+            buf[window_start:window_stop] == MARKER_BYTES[0][1])
+        for offset, value in MARKER_BYTES[1:]:
+            candidates = candidates[buf[candidates + offset] == value]
+        candidates = candidates[
+            buf[candidates + RECORD_NUMBER_OFFSET] ==
+            buf[candidates + SAME_RECORD_NUMBER_OFFSET]]
+        if len(candidates) > 0:
+            return int(candidates[0])
+        window_start = window_stop
+    return len(buf)
+
+
+def skipped_ranges(runs, total_bytes, start=0):
+    # Given the (byte_offset, frame_count) runs from frame_runs(), returns the
+    # (start, stop) byte ranges that didn't hold valid frames.
+    ranges = []
+    pos = start
+    for offset, count in runs:
+        if offset > pos:
+            ranges.append((pos, offset))
+        pos = offset + count * FRAME_DTYPE.itemsize
+    if total_bytes > pos:
+        ranges.append((pos, total_bytes))
+    return ranges
+
+
+def resume_offset(runs, total_bytes, start=0):
+    # Where to start scanning once more data is appended to a buffer that
+    # frame_runs() has already scanned: the end of the last valid frame, or
+    # the first offset that didn't have a whole frame's worth of bytes after
+    # it.
+    pos = start
+    if runs:
+        offset, count = runs[-1]
+        pos = offset + count * FRAME_DTYPE.itemsize
+    return max(pos, total_bytes - FRAME_DTYPE.itemsize + 1)
+
+
+class FrameDecoder(object):
+    """
+    Finds valid frames in .itf data that arrives a piece at a time, keeping
+    partial frames and the record counter between pieces. Feeding a file
+    through decode() in pieces finds the same frames and record numbers as
+    reading it all at once. With long_gaps, record numbers are reconstructed
+    across long gaps; see unwrap_record_numbers().
+    """
+
+    def __init__(self, long_gaps=False):
+        self.pending = np.zeros(0, dtype=np.uint8)
+        # The file offset of pending[0]
+        self.pending_offset = 0
+        self.long_gaps = long_gaps
+        self.last_record_counter = None
+        self.last_record_number = -1
+        self.last_offset = None
+
+    def decode(self, data):
+        """
+        Takes the next piece of the file, as bytes or a uint8 array.
+        Returns (frames, record_numbers, offsets) for the complete, valid
+        frames that are now available; offsets are file offsets.
+        """
+        buf = np.concatenate([
+            self.pending, np.frombuffer(data, dtype=np.uint8)])
+        runs = list(frame_runs(buf))
+        frames = np.concatenate(
+            [frames_at(buf, o, c) for o, c in runs] +
+            [np.zeros(0, dtype=FRAME_DTYPE)])
+        offsets = run_frame_offsets(runs) + self.pending_offset
+        resume = resume_offset(runs, len(buf))
+        self.pending = buf[resume:].copy()
+        self.pending_offset += resume
+
+        rnums = np.zeros(0, dtype=np.int32)
+        if len(frames) > 0:
+            if self.long_gaps:
+                rnums = _reconstruct_record_numbers(
+                    frames['recordNumber'],
+                    offsets,
+                    self.last_record_counter,
+                    self.last_offset)
+            else:
+                rnums = unwrap_record_numbers(
+                    frames['recordNumber'], self.last_record_counter)
+            rnums += self.last_record_number + (
+                1 if self.last_record_counter is None else 0)
+            self.last_record_counter = frames['recordNumber'][-1]
+            self.last_record_number = int(rnums[-1])
+            self.last_offset = offsets[-1]
+        return frames, rnums, offsets
+
+
+class FollowReader(object):
+    """
+    Reads a .itf file while it's still being written. Each call to
+    read_new() decodes only the complete frames appended since the last
+    call, and returns the new samples:
+
+    >>> follower = FollowReader('scan.itf')
+    >>> samples = follower.read_new()  # INTERNAL_DTYPE, from sample 0
+    >>> samples = follower.read_new()  # Picks up where that left off
+
+    Joined together, the results are the same as read_data()'s output.
+    """
+
+    def __init__(self, itk_filename, read_size=READ_BYTES):
+        self.filename = itk_filename
+        self.read_size = read_size
+        self.decoder = FrameDecoder()
+        # How far into the file we've read, and how many samples we've
+        # returned
+        self.position = 0
+        self.sample_count = 0
+
+    def read_new(self):
+        frames = []
+        rnums = []
+        with open(self.filename, "rb") as f:
+            f.seek(self.position)
+            while True:
+                data = f.read(self.read_size)
+                if not data:
+                    break
+                self.position += len(data)
+                chunk_frames, chunk_rnums, _ = self.decoder.decode(data)
+                frames.append(chunk_frames)
+                rnums.append(chunk_rnums)
+        first = self.sample_count
+        self.sample_count = self.decoder.last_record_number + 1
+        internal_struct = empty_internal_type(self.sample_count - first)
+        if frames:
+            fill_internal_type(
+                internal_struct,
+                np.concatenate(frames),
+                np.concatenate(rnums) - first)
+        return internal_struct
+
+
+def iter_blocks(
+        itk_filename,
+        block_size=BLOCK_SAMPLES,
+        read_size=READ_BYTES,
+        channels=None,
+        long_gaps=False):
+    """
+    Reads itk_filename a piece at a time, and yields INTERNAL_DTYPE arrays
+    of block_size samples each (the last one may be shorter). Joined
+    together, the blocks are the same as read_data()'s output, but memory
+    use doesn't depend on the length of the recording. As with read_data(),
+    channels selects which channels to decode, and long_gaps reconstructs
+    long gaps.
+    """
+    decoder = FrameDecoder(long_gaps)
+    channel_count = CHANNELS if channels is None else len(channels)
+    block = empty_internal_type(block_size, channel_count)
+    block_start = 0
+    with open(itk_filename, "rb") as f:
+        while True:
+            data = f.read(read_size)
+            if not data:
+                break
+            frames, rnums, _ = decoder.decode(data)
+            while len(frames) > 0:
+                in_block = np.searchsorted(rnums, block_start + block_size)
+                fill_internal_type(
+                    block,
+                    frames[:in_block],
+                    rnums[:in_block] - block_start,
+                    channels)
+                if in_block == len(frames):
+                    break
+                yield block
+                frames, rnums = frames[in_block:], rnums[in_block:]
+                block = empty_internal_type(block_size, channel_count)
+                block_start += block_size
+    samples = decoder.last_record_number + 1 - block_start
+    if samples > 0:
+        yield block[:samples]
+
+
+def channel_bytes(frames, channels):
+    # The raw, big-endian bytes of some channels, shaped
+    # (frames, channels, 3). This doesn't decode anything.
+    raw = frames.view(np.uint8).reshape(len(frames), FRAME_DTYPE.itemsize)
+    byte_indexes = CHANNEL_OFFSETS[channels][:, np.newaxis] + np.arange(3)
+    return raw[:, byte_indexes]
+
+
+def count_clipped(infile, channels, read_size=READ_BYTES):
+    """
+    Counts the samples of each of channels that are at VAL_MAX and VAL_MIN,
+    reading the .itf file infile a piece at a time and checking the raw
+    3-byte samples rather than decoding them.
+
+    Returns (samples, low_counts, high_counts), where samples counts missing
+    frames too, just like read_data()'s output does.
+    """
+    channels = np.asarray(channels, dtype=np.intp)
+    low_counts = np.zeros(len(channels), dtype=np.int64)
+    high_counts = np.zeros(len(channels), dtype=np.int64)
+    decoder = FrameDecoder()
+    infile.seek(0)
+    while True:
+        data = infile.read(read_size)
+        if not data:
+            break
+        frames, _, _ = decoder.decode(data)
+        samples = channel_bytes(frames, channels)
+        high_counts += np.sum(np.all(samples == VAL_MAX_BYTES, axis=2), 0)
+        low_counts += np.sum(np.all(samples == VAL_MIN_BYTES, axis=2), 0)
+    return (decoder.last_record_number + 1, low_counts, high_counts)
 
 
 def is_good_frame(frame):
@@ -163,23 +871,48 @@ def generate_valid_frames(infile):
 
 
 def convert_channels_to_le_i4(frames):
-    int32_data = np.zeros((len(frames), CHANNELS), '<i4')
-    int32_data.dtype = np.byte
-    int32_data = int32_data.reshape(len(frames), CHANNELS, 4)
-    # We're swapping both the order of the channel blocks and the order of the
-    # bytes
-    int32_data[:, 0:9, 0:3] = frames['chans08to00'][:, ::-1, ::-1]
-    int32_data[:, 9:29, 0:3] = frames['chans28to09'][:, ::-1, ::-1]
-    int32_data[:, 29:49, 0:3] = frames['chans48to29'][:, ::-1, ::-1]
-    int32_data[:, 49:69, 0:3] = frames['chans68to49'][:, ::-1, ::-1]
-    int32_data[:, 69:89, 0:3] = frames['chans88to69'][:, ::-1, ::-1]
-    int32_data[:, 89:109, 0:3] = frames['chans108to89'][:, ::-1, ::-1]
-    int32_data[:, 109:128, 0:3] = frames['chans127to109'][:, ::-1, ::-1]
-    sign_mask = int32_data[:, :, 2] < 0
-    int32_data[:, :, 3][sign_mask] = -1
-    int32_data = int32_data.reshape(len(frames), CHANNELS * 4)
-    int32_data.dtype = '<i4'
-    return int32_data
+    return unpack_channels(frames)
+
+
+def unpack_channels(frames, out=None, channels=None):
+    """
+    Converts frames' 3-byte, big-endian channel samples to int32, writing
+    them into out: any int32 array shaped (len(frames), CHANNELS), such as
+    an INTERNAL_DTYPE array's 'channels' field or a memmap. Allocates out if
+    it isn't given. Returns out.
+
+    If channels is a list of channel numbers, only those are converted, and
+    out is shaped (len(frames), len(channels)).
+    """
+    if out is None:
+        channel_count = CHANNELS if channels is None else len(channels)
+        out = np.empty((len(frames), channel_count), dtype='<i4')
+    if len(frames) == 0:
+        return out
+    frames = np.ascontiguousarray(frames)
+    if channels is not None:
+        for i, offset in enumerate(CHANNEL_OFFSETS[channels]):
+            samples = np.ndarray(
+                shape=(len(frames),),
+                dtype='>i4',
+                buffer=frames,
+                offset=offset,
+                strides=(FRAME_DTYPE.itemsize,))
+            np.right_shift(samples, 8, out=out[:, i])
+        return out
+    for name, first, stop in CHANNEL_BLOCKS:
+        # Read each sample, plus the byte after it, as a big-endian int32
+        # straight out of the frames. That's sample * 256 + junk, and an
+        # arithmetic shift gets rid of the junk and sign-extends.
+        samples = np.ndarray(
+            shape=(len(frames), stop - first),
+            dtype='>i4',
+            buffer=frames,
+            offset=_field_offset(name),
+            strides=(FRAME_DTYPE.itemsize, 3))
+        # Channels are stored in descending order within a block
+        np.right_shift(samples, 8, out=out[:, first:stop][:, ::-1])
+    return out
 
 
 def _default_card():
@@ -216,37 +949,683 @@ def scale_factor(gain):
     return (V_REF * MICROV) / (BIT_RES * gain)
 
 
-def convert_frames_to_internal_type(frames):
+def card_scale_factor(card):
+    # The factor that turns a card's channel samples into microvolts: from
+    # its gain, or its placeholder scale_factor if the gain isn't known.
+    if card['gain'] == 'unknown':
+        return card['scale_factor']
+    return scale_factor(card['gain'])
+
+
+def convert_frames_to_internal_type(frames, channels=None, offsets=None):
     # Simplifies the frames structure, and converts its 3-byte ints into
-    # int32.
-    rnums = record_numbers(frames)
-    internal_struct = np.zeros((rnums[-1] + 1), dtype=INTERNAL_DTYPE)
+    # int32. If channels is given, only those channels are converted. Pass
+    # the frames' byte offsets to reconstruct long gaps; see
+    # unwrap_record_numbers().
+    rnums = record_numbers(frames, offsets)
+    channel_count = CHANNELS if channels is None else len(channels)
+    length = rnums[-1] + 1 if len(rnums) else 0
+    internal_struct = empty_internal_type(length, channel_count)
+    fill_internal_type(internal_struct, frames, rnums, channels)
+    return internal_struct
+
+
+def empty_internal_type(length, channel_count=CHANNELS):
+    # An INTERNAL_DTYPE array with every sample marked missing
+    internal_struct = np.zeros(length, dtype=internal_dtype(channel_count))
     internal_struct['is_missing'] = True
-    internal_struct['is_missing'][rnums] = False
-    internal_struct['channels'][rnums] = convert_channels_to_le_i4(frames)
-    internal_struct['error_flags'][rnums] = frames['errorFlags']
-    internal_struct['status_flags'][rnums] = frames['statusFlags']
-    internal_struct['parallel_port'][rnums] = frames['parallelPort']
-    internal_struct['tr_register'][rnums] = frames['trRegister']
     return internal_struct
 
 
-def record_numbers(frames):
-    record_counter = frames['recordNumber'].astype(np.int32)
+def fill_internal_type(internal_struct, frames, rows, channels=None):
+    # Copies frames into rows of internal_struct. If it only holds some
+    # channels, pass their numbers as channels.
+    if len(rows) == 0:
+        return
+    internal_struct['is_missing'][rows] = False
+    if np.all(np.diff(rows) == 1):
+        # No gaps, so we can decode straight into internal_struct
+        unpack_channels(
+            frames,
+            internal_struct['channels'][rows[0]:rows[-1] + 1],
+            channels)
+    else:
+        internal_struct['channels'][rows] = unpack_channels(
+            frames, channels=channels)
+    internal_struct['error_flags'][rows] = frames['errorFlags']
+    internal_struct['status_flags'][rows] = frames['statusFlags']
+    internal_struct['parallel_port'][rows] = frames['parallelPort']
+    internal_struct['tr_register'][rows] = frames['trRegister']
+
+
+def record_numbers(frames, offsets=None):
+    # With offsets, the frames' byte offsets in the file, long gaps are
+    # reconstructed as unwrap_record_numbers() describes, and ambiguous ones
+    # are logged.
+    if offsets is None:
+        return unwrap_record_numbers(frames['recordNumber'])
+    return _reconstruct_record_numbers(frames['recordNumber'], offsets)
+
+
+def unwrap_record_numbers(
+        record_counter,
+        previous_counter=None,
+        offsets=None,
+        previous_offset=None):
+    """
+    Turns recordNumber values into sample numbers, counting from 0. If these
+    frames follow others, pass the last frame's recordNumber as
+    previous_counter, and the results count from its sample number instead.
+
+    recordNumber is one byte, so on its own it can't tell us about gaps of
+    more than 255 frames. If you pass the frames' byte offsets in the file
+    (and the previous frame's, as previous_offset), then wherever bytes were
+    skipped between two frames, we count as many 256-frame wraps as gets us
+    closest to the number of frames those bytes could have held. See
+    ambiguous_gaps() for the gaps where that's a guess.
+    """
+    return _unwrap_record_numbers(
+        record_counter, previous_counter, offsets, previous_offset)[0]
+
+
+def ambiguous_gaps(
+        record_counter,
+        offsets,
+        previous_counter=None,
+        previous_offset=None):
+    """
+    The indexes of the frames that come after skipped bytes that don't
+    clearly say how many frames were lost: the record counter and the
+    number of bytes skipped disagree by more than AMBIGUOUS_GAP_FRAMES.
+    unwrap_record_numbers()'s sample numbers for these frames, and the ones
+    after them, may be off by a multiple of 256.
+    """
+    ambiguous = _unwrap_record_numbers(
+        record_counter, previous_counter, offsets, previous_offset)[1]
+    return np.flatnonzero(ambiguous)
+
+
+def _unwrap_record_numbers(
+        record_counter,
+        previous_counter=None,
+        offsets=None,
+        previous_offset=None):
+    # Returns (sample numbers, whether each frame follows an ambiguous gap)
+    record_counter = record_counter.astype(np.int32)
+    if previous_counter is not None:
+        record_counter = np.concatenate([[previous_counter], record_counter])
+        if offsets is not None:
+            offsets = np.concatenate([[previous_offset], offsets])
     changes = np.diff(record_counter)
 
     # Since recordNumber is a ubyte, when we hit 255 we wrap back to 0 and the
     # derivative is -255. Adding 256 to this brings the numbers back around.
     # Note that this fails if we wind up skipping more than 255 frames in a row
-    # but there's no way to detect that anyhow
-    changes[changes < 0] += 256
+    # unless we know where the skipped bytes are.
+    changes[changes < 0] += RECORD_COUNTER_WRAP
+    ambiguous = np.zeros(len(changes), dtype=bool)
+    if offsets is not None:
+        # How many frames after the previous one each frame would be, if
+        # every skipped byte had been part of a frame
+        byte_frames = np.diff(offsets) / float(FRAME_DTYPE.itemsize)
+        gaps = np.flatnonzero(byte_frames > 1)
+        wraps = np.maximum(np.round(
+            (byte_frames[gaps] - changes[gaps]) / RECORD_COUNTER_WRAP), 0)
+        changes[gaps] += (wraps * RECORD_COUNTER_WRAP).astype(changes.dtype)
+        ambiguous[gaps] = (
+            np.abs(changes[gaps] - byte_frames[gaps]) > AMBIGUOUS_GAP_FRAMES)
     recnums = np.cumsum(changes)
 
-    out = np.zeros(len(frames), dtype=np.int32)
+    out = np.zeros(len(record_counter), dtype=np.int32)
     out[1:] = recnums
+    flags = np.zeros(len(record_counter), dtype=bool)
+    flags[1:] = ambiguous
+    if previous_counter is not None:
+        return out[1:], flags[1:]
+    return out, flags
+
+
+def _reconstruct_record_numbers(
+        record_counter,
+        offsets,
+        previous_counter=None,
+        previous_offset=None):
+    # unwrap_record_numbers() with offsets, logging any ambiguous gaps
+    rnums, ambiguous = _unwrap_record_numbers(
+        record_counter, previous_counter, offsets, previous_offset)
+    for offset in offsets[ambiguous]:
+        logger.warning(
+            "Can't tell how many frames were lost before byte {}; later "
+            "samples may be off by a multiple of {}.".format(
+                offset, RECORD_COUNTER_WRAP))
+    return rnums
+
+
+def fill_gaps(channels, is_missing, method='hold', before=None, after=None):
+    """
+    Fills in the missing samples of channels (samples along the first axis)
+    from the good ones around them, for every channel at once:
+
+    hold:   Repeat the last good sample. A leading gap takes the first good
+            sample after it.
+    linear: Draw a straight line from the good sample before the gap to the
+            one after it. Gaps at either end are held.
+    nan:    Make missing samples NaN.
+
+    Samples with no good sample on either side are left alone. If these
+    samples are part of a longer recording, before and after can give the
+    nearest good samples outside them, as (distance in samples, values).
+
+    Returns a new array: the same dtype as channels for hold, and floating
+    point for linear and nan.
+    """
+    if method not in GAP_FILL_METHODS:
+        raise ValueError("Unknown gap fill {}; use one of {}".format(
+            method, ', '.join(GAP_FILL_METHODS)))
+    out_dtype = channels.dtype
+    if method != 'hold' and channels.dtype.kind != 'f':
+        out_dtype = np.float64
+    out = np.array(channels, dtype=out_dtype)
+    rows = np.flatnonzero(is_missing)
+    if len(rows) == 0:
+        return out
+    if method == 'nan':
+        out[rows] = np.nan
+        return out
+
+    # The position of the good sample before and after each missing one;
+    # -1 and length mean there isn't one in channels.
+    length = len(channels)
+    positions = np.arange(length)
+    prev_rows = np.maximum.accumulate(
+        np.where(is_missing, -1, positions))[rows]
+    next_rows = np.minimum.accumulate(
+        np.where(is_missing, length, positions)[::-1])[::-1][rows]
+    has_prev = prev_rows >= 0
+    has_next = next_rows < length
+    prev_values = channels[np.maximum(prev_rows, 0)]
+    next_values = channels[np.minimum(next_rows, length - 1)]
+    prev_positions = prev_rows.astype(np.float64)
+    next_positions = next_rows.astype(np.float64)
+    if before is not None:
+        distance, values = before
+        prev_values[~has_prev] = values
+        prev_positions[~has_prev] = -distance
+        has_prev[:] = True
+    if after is not None:
+        distance, values = after
+        next_values[~has_next] = values
+        next_positions[~has_next] = length - 1 + distance
+        has_next[:] = True
+
+    # Broadcasts per-row arrays across channels
+    shape = (len(rows),) + (1,) * (channels.ndim - 1)
+    filled = np.where(
+        has_prev.reshape(shape), prev_values, next_values).astype(out_dtype)
+    if method == 'linear':
+        both = has_prev & has_next
+        weight = (rows[both] - prev_positions[both]) / (
+            next_positions[both] - prev_positions[both])
+        weight = weight.reshape((-1,) + shape[1:])
+        filled[both] = prev_values[both] + weight * (
+            next_values[both] - prev_values[both])
+    has_any = has_prev | has_next
+    out[rows[has_any]] = filled[has_any]
     return out
 
 
+def fill_gap_blocks(blocks, method='hold'):
+    """
+    Fills gaps in a stream of INTERNAL_DTYPE blocks, like the ones from
+    iter_blocks(), using the samples around them even when a gap spans
+    blocks. Yields (block, filled) for each block, where filled is its
+    channels as fill_gaps() returns them.
+
+    A block that ends in a gap is held back until a later block has a good
+    sample, so a long gap keeps its blocks in memory.
+    """
+    if method == 'nan':
+        # Nothing depends on other blocks
+        for block in blocks:
+            yield block, fill_gaps(
+                block['channels'], block['is_missing'], method)
+        return
+    waiting = []
+    position = 0
+    # The absolute position and channels of the last good sample we've
+    # yielded
+    last_good = None
+    for block in blocks:
+        waiting.append((position, block))
+        position += len(block)
+        good = np.flatnonzero(~block['is_missing'])
+        if len(good) == 0:
+            continue
+        next_good = (waiting[-1][0] + good[0], block['channels'][good[0]])
+        for start, held in waiting[:-1]:
+            after = (next_good[0] - (start + len(held) - 1), next_good[1])
+            yield held, _fill_block(held, start, method, last_good, after)
+            last_good = _last_good(held, start, last_good)
+        waiting = waiting[-1:]
+        if not block['is_missing'][-1]:
+            start, held = waiting.pop()
+            yield held, _fill_block(held, start, method, last_good, None)
+            last_good = _last_good(held, start, last_good)
+    for start, held in waiting:
+        yield held, _fill_block(held, start, method, last_good, None)
+        last_good = _last_good(held, start, last_good)
+
+
+def _fill_block(block, start, method, last_good, after):
+    before = None
+    if last_good is not None:
+        before = (start - last_good[0], last_good[1])
+    return fill_gaps(
+        block['channels'], block['is_missing'], method, before, after)
+
+
+def _last_good(block, start, last_good):
+    good = np.flatnonzero(~block['is_missing'])
+    if len(good) == 0:
+        return last_good
+    return (start + good[-1], block['channels'][good[-1]])
+
+
+def stored_dtype(storage):
+    # The dtype itf2hdf5 stores channel samples as, for a --storage mode
+    if storage == 'packed24':
+        return np.dtype(('<u1', 3))
+    if storage in ('int32', 'delta'):
+        return np.dtype('<i4')
+    raise ValueError("Unknown storage {}; use one of {}".format(
+        storage, ', '.join(STORAGE_MODES)))
+
+
+def encode_channels(values, storage, previous=None):
+    """
+    Encodes int32 channel samples (along the first axis of values) for
+    storage:
+
+    int32:    Unchanged.
+    packed24: The low three bytes of each sample, little-endian.
+    delta:    The difference from the previous sample. Pass the last
+              samples before values as previous; the default is 0.
+    """
+    if storage == 'packed24':
+        values = np.ascontiguousarray(values, dtype='<i4')
+        return np.ascontiguousarray(
+            values.view(np.uint8).reshape(values.shape + (4,))[..., :3])
+    if storage == 'delta':
+        if previous is None:
+            previous = np.zeros(values.shape[1:], dtype='<i4')
+        return np.diff(values, axis=0, prepend=[previous]).astype('<i4')
+    stored_dtype(storage)
+    return values.astype('<i4', copy=False)
+
+
+def decode_channels(stored, storage, previous=None):
+    # Undoes encode_channels(), returning int32 samples
+    if storage == 'packed24':
+        out = np.zeros(stored.shape[:-1], dtype='<i4')
+        out_bytes = out.view(np.uint8).reshape(out.shape + (4,))
+        out_bytes[..., 1:] = stored
+        # The shift back down sign-extends the top byte
+        out >>= 8
+        return out
+    if storage == 'delta':
+        out = np.cumsum(stored, axis=0, dtype='<i4')
+        if previous is not None:
+            out += previous
+        return out
+    stored_dtype(storage)
+    return stored
+
+
+def read_stored_channel(ds, start=0, stop=None):
+    """
+    Reads samples start through stop of a channel dataset written by
+    itf2hdf5 (an h5py Dataset, or anything with attrs and slicing), and
+    undoes its --storage encoding.
+    """
+    storage = _attr_str(ds.attrs.get('storage', 'int32'))
+    if storage == 'delta':
+        # Every sample depends on all of the ones before it
+        return decode_channels(ds[:stop], storage)[start:]
+    return decode_channels(ds[start:stop], storage)
+
+
+def iter_stored_channel(ds):
+    """
+    Yields a channel dataset written by itf2hdf5 as consecutive int32
+    blocks, one storage chunk at a time, so each chunk is only read and
+    decompressed once.
+    """
+    storage = _attr_str(ds.attrs.get('storage', 'int32'))
+    step = _chunk_samples(ds)
+    previous = None
+    for start in range(0, ds.shape[0], step):
+        values = decode_channels(ds[start:start + step], storage, previous)
+        previous = values[-1]
+        yield values
+
+
+def pyramid_bins(values, factor):
+    # Summarizes each run of factor samples (along the first axis) as a
+    # PYRAMID_DTYPE bin. The last bin may cover fewer samples.
+    full = (len(values) // factor) * factor
+    pieces = [values[:full].reshape((-1, factor) + values.shape[1:])]
+    if full < len(values):
+        pieces.append(values[full:][np.newaxis])
+    bins = np.zeros(
+        (sum(len(p) for p in pieces),) + values.shape[1:],
+        dtype=PYRAMID_DTYPE)
+    row = 0
+    for piece in pieces:
+        bins['min'][row:row + len(piece)] = piece.min(axis=1)
+        bins['max'][row:row + len(piece)] = piece.max(axis=1)
+        bins['mean'][row:row + len(piece)] = piece.mean(axis=1)
+        row += len(piece)
+    return bins
+
+
+def overview(h5f, channel, start=0.0, stop=None, width=1000):
+    """
+    Gets what's needed to draw a channel from an itf2hdf5 file from start to
+    stop seconds, about width pixels wide.
+
+    Returns (factor, bins): bins is a PYRAMID_DTYPE array from the coarsest
+    --pyramid level that still has a bin for every pixel, and each bin
+    covers factor samples. When no level is coarse enough, factor is 1 and
+    each bin is one sample.
+    """
+    ds = h5f['/channels'][channel]
+    samples_per_second = h5f.attrs['samples_per_second']
+    first = max(int(start * samples_per_second), 0)
+    last = ds.shape[0]
+    if stop is not None:
+        last = min(int(np.ceil(stop * samples_per_second)), last)
+    last = max(first, last)
+    samples_per_pixel = (last - first) / float(width)
+    factor = 1
+    if 'pyramid' in h5f:
+        for level in h5f['/pyramid'].values():
+            level_factor = int(level.attrs['factor'])
+            if factor < level_factor <= samples_per_pixel:
+                factor = level_factor
+    if factor == 1:
+        return 1, pyramid_bins(read_stored_channel(ds, first, last), 1)
+    level = h5f['/pyramid/level_{}'.format(factor)]
+    return factor, level[channel][first // factor:-(-last // factor)]
+
+
+class Hdf5Data(object):
+    """
+    A file written by itf2hdf5, read lazily. Channels come back in
+    microvolts, as float32, and only the chunks a read touches are read and
+    decoded:
+
+    >>> data = Hdf5Data('data.hdf5')
+    >>> zygo = data['zygo']        # A channel, by name or number
+    >>> zygo[1000:2000]            # Samples 1000 through 1999
+    >>> zygo.seconds(2.0, 4.5)     # The samples from 2 to 4.5 seconds
+    >>> data[[8, 'corr'], ::10]    # Every 10th sample, samples x channels
+    >>> data.is_missing[1000:2000]
+
+    Decoded chunks are kept in a cache of the cache_chunks most recently
+    used ones, shared by all of the file's channels. Pass one of
+    GAP_FILL_METHODS as fill to fill in missing samples, as fill_gaps()
+    does, from the good samples around them.
+    """
+
+    def __init__(self, h5_filename, cache_chunks=CACHE_CHUNKS, fill=None):
+        import h5py
+        if fill is not None and fill not in GAP_FILL_METHODS:
+            raise ValueError("Unknown gap fill {}; use one of {}".format(
+                fill, ', '.join(GAP_FILL_METHODS)))
+        self.filename = h5_filename
+        self.h5f = h5py.File(h5_filename, 'r')
+        self.cache_chunks = cache_chunks
+        self.fill = fill
+        self.chunk_reads = 0
+        self._chunks = OrderedDict()
+        self._channels = {}
+        self.samples_per_second = float(self.h5f.attrs['samples_per_second'])
+        self.channel_numbers, self.channel_names = self._find_channels()
+
+    def _find_channels(self):
+        # Returns the saved channel numbers, and a dict of the aliases of
+        # each
+        group = self.h5f['/channels']
+        numbered = {}
+        for name in group:
+            match = CHANNEL_LABEL_RE.match(name)
+            if match:
+                numbered[int(match.group(1))] = group[name]
+        names = {}
+        for name in group:
+            if CHANNEL_LABEL_RE.match(name):
+                continue
+            ds = group[name]
+            for number, numbered_ds in numbered.items():
+                if ds == numbered_ds:
+                    names[name] = number
+        return sorted(numbered), names
+
+    def __len__(self):
+        return self.h5f['/is_missing'].shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            return self.channel(key)
+        channels, samples = key
+        if isinstance(channels, (list, tuple)):
+            columns = [self.channel(c)[samples] for c in channels]
+            return np.stack(columns, axis=-1)
+        return self.channel(channels)[samples]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def channel(self, key):
+        """
+        Returns a ScaledChannel, for a channel number, name or dataset name
+        like channel_008. Raises KeyError if the file doesn't have it.
+        """
+        number = self.channel_names.get(key, key)
+        match = CHANNEL_LABEL_RE.match(str(number))
+        if match:
+            number = int(match.group(1))
+        if number not in self.channel_numbers:
+            raise KeyError("No channel {}".format(key))
+        if number not in self._channels:
+            self._channels[number] = ScaledChannel(self, number)
+        return self._channels[number]
+
+    @property
+    def is_missing(self):
+        return self.h5f['/is_missing']
+
+    @property
+    def parallel_port(self):
+        return self.h5f['/parallel_port']
+
+    def sample_range(self, start=0.0, stop=None):
+        # The slice of samples from start to stop seconds
+        first = max(int(start * self.samples_per_second), 0)
+        last = len(self)
+        if stop is not None:
+            last = min(int(np.ceil(stop * self.samples_per_second)), last)
+        return slice(first, max(first, last))
+
+    def good_sample_near(self, index, direction):
+        """
+        The nearest sample to index that isn't missing, searching forward
+        (direction=1) or backward (direction=-1) and including index itself.
+        Returns None if there isn't one.
+        """
+        is_missing = self.is_missing
+        while 0 <= index < len(self):
+            if direction > 0:
+                stop = min(index + BLOCK_SAMPLES, len(self))
+                good = np.flatnonzero(~is_missing[index:stop])
+                if len(good):
+                    return index + int(good[0])
+                index = stop
+            else:
+                start = max(index + 1 - BLOCK_SAMPLES, 0)
+                good = np.flatnonzero(~is_missing[start:index + 1])
+                if len(good):
+                    return start + int(good[-1])
+                index = start - 1
+        return None
+
+    def _chunk(self, channel, index):
+        # A channel's index-th chunk, scaled, from the cache if possible
+        key = (channel.number, index)
+        if key in self._chunks:
+            self._chunks[key] = self._chunks.pop(key)
+            return self._chunks[key]
+        self.chunk_reads += 1
+        values = channel.decode_chunk(index)
+        self._chunks[key] = values
+        while len(self._chunks) > self.cache_chunks:
+            self._chunks.popitem(last=False)
+        return values
+
+    def close(self):
+        self._chunks.clear()
+        self.h5f.close()
+
+
+class ScaledChannel(object):
+    """
+    One channel of an Hdf5Data. Slice it like a numpy array to get float32
+    microvolts.
+    """
+
+    def __init__(self, data, number):
+        self.data = data
+        self.number = number
+        self.ds = data.h5f['/channels'][_channel_label(number)]
+        self.attrs = self.ds.attrs
+        self.storage = _attr_str(self.attrs.get('storage', 'int32'))
+        self.chunk_samples = _chunk_samples(self.ds)
+        self.scale_factor = card_scale_factor({
+            'gain': _attr_str(self.attrs.get('gain', 'unknown')),
+            'scale_factor': self.attrs.get('scale_factor', 1),
+        })
+        # For delta storage, the sample before each chunk we've decoded
+        self._chunk_previous = {0: None}
+
+    def __len__(self):
+        return self.ds.shape[0]
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step > 0:
+                return self.read(start, stop)[::step]
+            if start <= stop:
+                return np.zeros(0, dtype=np.float32)
+            # Going backwards, start is the last sample and stop is before
+            # the first
+            return self.read(stop + 1, start + 1)[::step]
+        index = int(key)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Sample {} is out of range".format(key))
+        return self.read(index, index + 1)[0]
+
+    def seconds(self, start=0.0, stop=None):
+        return self[self.data.sample_range(start, stop)]
+
+    def read(self, start, stop):
+        # Samples start through stop, built from the chunks they touch
+        stop = min(stop, len(self))
+        if start >= stop:
+            return np.zeros(0, dtype=np.float32)
+        first = start // self.chunk_samples
+        last = (stop - 1) // self.chunk_samples
+        pieces = [self.data._chunk(self, i) for i in range(first, last + 1)]
+        offset = first * self.chunk_samples
+        values = pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+        values = values[start - offset:stop - offset]
+        if self.data.fill is not None:
+            values = self._fill(start, stop, values)
+        return values
+
+    def _fill(self, start, stop, values):
+        is_missing = self.data.is_missing[start:stop]
+        if not is_missing.any():
+            return values
+        before = after = None
+        if self.data.fill != 'nan':
+            # The good samples just outside this range
+            previous = self.data.good_sample_near(start - 1, -1)
+            if previous is not None:
+                before = (start - previous, self.read(previous, previous + 1))
+            following = self.data.good_sample_near(stop, 1)
+            if following is not None:
+                after = (following - (stop - 1),
+                         self.read(following, following + 1))
+        return fill_gaps(values, is_missing, self.data.fill, before, after)
+
+    def decode_chunk(self, index):
+        start = index * self.chunk_samples
+        stored = self.ds[start:start + self.chunk_samples]
+        values = decode_channels(
+            stored, self.storage, self._previous(index))
+        if self.storage == 'delta':
+            self._chunk_previous[index + 1] = values[-1]
+        return values.astype(np.float32) * np.float32(self.scale_factor)
+
+    def _previous(self, index):
+        # With delta storage, every chunk depends on the ones before it, so
+        # decode any we haven't seen yet. We only keep their last samples.
+        if self.storage != 'delta':
+            return None
+        known = max(i for i in self._chunk_previous if i <= index)
+        for i in range(known, index):
+            self.data._chunk(self, i)
+        return self._chunk_previous[index]
+
+
+def _chunk_samples(ds):
+    # How many samples each of ds's chunks holds. A --matrix channel is a
+    # virtual dataset, so we use the chunks of the matrix it reads from.
+    if ds.chunks:
+        return ds.chunks[0]
+    if getattr(ds, 'is_virtual', False):
+        sources = ds.virtual_sources()
+        if sources and sources[0].file_name == '.':
+            source = ds.file[sources[0].dset_name]
+            if source.chunks:
+                return source.chunks[0]
+    return BLOCK_SAMPLES
+
+
+def _channel_label(channel_number):
+    return 'channel_{:03d}'.format(channel_number)
+
+
+def _attr_str(val):
+    if isinstance(val, bytes):
+        return val.decode('utf-8')
+    return val
+
+
 def card_order_from_string(card_order_string):
     return [int(card_num) for card_num in card_order_string.split(',')]
 
@@ -273,6 +1652,21 @@ def channel_map(card_order):
     return np.repeat(card_ar, CHANNELS_PER_CARD)
 
 
+def channel_name_mapping(name_str):
+    """
+    Turns a string like '1:foo,2:bar' into the dict
+    {1: 'foo', 2: 'bar'}
+    May raise an exception if the string doesn't follow this format.
+    Returns {} for an empty string.
+    """
+    mapping_strs = str(name_str).split(',')
+    str_pairs = [m.split(':') for m in mapping_strs]
+    pairs = [
+        [int(p[0]), p[1]] for p in str_pairs
+        if len(p) == 2]
+    return dict(pairs)
+
+
 def card_for_channel(cards, channel_number, channel_map):
     return cards[channel_map[channel_number]]
 
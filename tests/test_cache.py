@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+from os import path
+
+import numpy as np
+
+from read_itek import cache
+from read_itek import reader
+
+DATA_PATH = path.join(path.dirname(path.abspath(__file__)), "data")
+
+
+def test_cached_read_matches(tmpdir):
+    itf_file = path.join(DATA_PATH, "simple.itf")
+    decode_cache = cache.DecodeCache(str(tmpdir.join("cache")))
+    data, cards = reader.read_data(itf_file, cache=decode_cache)
+    assert decode_cache.get(itf_file) is not None
+    cached_data, cached_cards = reader.read_data(itf_file, cache=decode_cache)
+    assert np.array_equal(cached_data, data)
+    assert cached_cards == cards
+    assert cached_cards[99]['gain'] == 'unknown'
+
+
+def test_cached_read_uses_current_ita(tmpdir):
+    itf_file = str(tmpdir.join("simple.itf"))
+    shutil.copy(path.join(DATA_PATH, "simple.itf"), itf_file)
+    shutil.copy(path.join(DATA_PATH, "simple.itf.ita"), itf_file + ".ita")
+    decode_cache = cache.DecodeCache(str(tmpdir.join("cache")))
+    _, cards = reader.read_data(itf_file, cache=decode_cache)
+    assert cards[0]['gain'] == 10000
+    with open(itf_file + ".ita") as f:
+        ita = f.read()
+    with open(itf_file + ".ita", "w") as f:
+        f.write(ita.replace("Card.0.gain=1", "Card.0.gain=0"))
+    _, cards = reader.read_data(itf_file, cache=decode_cache)
+    assert decode_cache.get(itf_file) is not None
+    assert cards[0]['gain'] == 400
+
+
+def test_evicts_least_recently_used(tmpdir):
+    first = str(tmpdir.join("first.itf"))
+    second = str(tmpdir.join("second.itf"))
+    for filename in [first, second]:
+        with open(path.join(DATA_PATH, "simple.itf"), "rb") as src:
+            with open(filename, "wb") as dest:
+                dest.write(src.read())
+    decode_cache = cache.DecodeCache(str(tmpdir.join("cache")))
+    reader.read_data(first, cache=decode_cache)
+    entry_bytes = sum(
+        os.path.getsize(os.path.join(decode_cache.directory, name))
+        for name in os.listdir(decode_cache.directory))
+    decode_cache.max_bytes = entry_bytes
+    reader.read_data(second, cache=decode_cache)
+    assert decode_cache.get(first) is None
+    assert decode_cache.get(second) is not None
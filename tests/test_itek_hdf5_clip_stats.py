@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from os import path
+
+import pytest
+
+from read_itek import itek_hdf5_clip_stats
+from read_itek import itf2hdf5
+import logging
+itek_hdf5_clip_stats.logger.setLevel(logging.DEBUG)
+
+DATA_PATH = path.join(path.dirname(path.abspath(__file__)), "data")
+
+
+def test_shows_help():
+    with pytest.raises(SystemExit):
+        itek_hdf5_clip_stats.main()
+
+
+def test_parallel_files_keep_order(tmpdir, capsys):
+    hdf5_file = str(tmpdir.join("simple.hdf5"))
+    itf2hdf5.main([path.join(DATA_PATH, 'simple.itf'), hdf5_file])
+    capsys.readouterr()
+    files = [hdf5_file, str(tmpdir.join("nope.hdf5")), hdf5_file]
+    itek_hdf5_clip_stats.main(files)
+    serial_out, _ = capsys.readouterr()
+    itek_hdf5_clip_stats.main(['--jobs=2'] + files)
+    parallel_out, _ = capsys.readouterr()
+    assert parallel_out == serial_out
+    assert 'nope.hdf5\terror' in parallel_out
+    assert 'channel_008' in parallel_out
+
+
+def test_same_stats_for_any_layout(tmpdir, capsys):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    plain_file = str(tmpdir.join("plain.hdf5"))
+    packed_file = str(tmpdir.join("packed.hdf5"))
+    itf2hdf5.main([infile, plain_file])
+    itf2hdf5.main([
+        '--matrix', '--storage=delta', '--chunk_size=1000',
+        infile, packed_file])
+    capsys.readouterr()
+    itek_hdf5_clip_stats.main([plain_file])
+    plain_out, _ = capsys.readouterr()
+    itek_hdf5_clip_stats.main([packed_file])
+    packed_out, _ = capsys.readouterr()
+    assert packed_out.replace(packed_file, plain_file) == plain_out
+    assert '3.31%' in plain_out
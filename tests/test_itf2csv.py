@@ -2,11 +2,12 @@
 # Written by Nathan Vack <njvack@wisc.edu>
 
 
+import io
 from os import path
 
 import pytest
 
-from read_itek import itf2csv
+from read_itek import itf2csv, reader
 import logging
 itf2csv.logger.setLevel(logging.DEBUG)
 
@@ -23,3 +24,24 @@ def test_basic_execute(capsys):
     itf2csv.main([infile])
     out, err = capsys.readouterr()
     assert len(out.split("\n")) == 130
+
+
+def test_chunked_rows_match_whole_rows(monkeypatch):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    data, cards = reader.read_data(infile)
+    whole = io.StringIO()
+    itf2csv.write_data(data, cards, whole)
+    monkeypatch.setattr(itf2csv, 'CSV_CHUNK_SAMPLES', 1000)
+    chunked = io.StringIO()
+    itf2csv.write_data(data, cards, chunked)
+    assert chunked.getvalue() == whole.getvalue()
+
+
+def test_precision(capsys):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    itf2csv.main(['--precision=3', infile])
+    out, err = capsys.readouterr()
+    lines = out.split("\n")
+    assert len(lines) == 130
+    assert all(len(v.lstrip('-').replace('.', '')) <= 3
+               for v in lines[0].split(','))
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import shutil
 from os import path
 
+import numpy as np
 import pytest
 
 from read_itek import itf2hdf5
+from read_itek import reader
 import logging
 itf2hdf5.logger.setLevel(logging.DEBUG)
 
@@ -25,4 +28,169 @@ def test_creates_file(tmpdir):
     itf2hdf5.main([infile, outfile])
     df = h5py.File(outfile, 'r')
     assert '/channels' in df
-    assert len(df['/channels'].items()) == 8
\ No newline at end of file
+    assert len(df['/channels'].items()) == 8
+
+
+def test_saved_data_matches_read_data(tmpdir):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    outfile = str(tmpdir.join("simple.hdf5"))
+    itf2hdf5.main([infile, outfile])
+    data, cards = reader.read_data(infile)
+    df = h5py.File(outfile, 'r')
+    assert (df['/channels/channel_008'][:] == data['channels'][:, 8]).all()
+    assert (df['/tr_register'][:] == data['tr_register']).all()
+    assert df['/channels/channel_008'].maxshape == (None,)
+
+
+def test_parallel_compression_matches(tmpdir):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    serial_file = str(tmpdir.join("serial.hdf5"))
+    parallel_file = str(tmpdir.join("parallel.hdf5"))
+    itf2hdf5.main([infile, serial_file])
+    itf2hdf5.main(['--jobs=3', infile, parallel_file])
+    serial = h5py.File(serial_file, 'r')
+    parallel = h5py.File(parallel_file, 'r')
+    for name in serial['/channels']:
+        expected = serial['/channels'][name]
+        actual = parallel['/channels'][name]
+        assert actual.compression == expected.compression
+        assert (actual[:] == expected[:]).all()
+
+
+def test_compression_options(tmpdir):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    outfile = str(tmpdir.join("simple.hdf5"))
+    itf2hdf5.main([
+        '--compression=lzf', '--shuffle', '--chunk_size=1000',
+        infile, outfile])
+    df = h5py.File(outfile, 'r')
+    ds = df['/channels/channel_008']
+    assert ds.compression == 'lzf'
+    assert ds.shuffle
+    assert ds.chunks == (1000,)
+
+
+def test_rejects_unknown_compression():
+    with pytest.raises(ValueError):
+        itf2hdf5.filter_options('rar')
+
+
+def test_matrix_layout(tmpdir):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    outfile = str(tmpdir.join("simple.hdf5"))
+    itf2hdf5.main(['--matrix', '--channel_names=9:zyg', infile, outfile])
+    data, cards = reader.read_data(infile)
+    df = h5py.File(outfile, 'r')
+    matrix = df['/channels_matrix']
+    assert matrix.shape == (len(data), 8)
+    assert list(matrix.attrs['channel_numbers']) == list(range(8, 16))
+    assert (matrix[:, 1] == data['channels'][:, 9]).all()
+    assert (df['/channels/zyg'][:] == data['channels'][:, 9]).all()
+    assert df['/channels/channel_009'].attrs['gain'] == 10000
+
+
+def test_matrix_without_saved_channels(tmpdir):
+    infile = str(tmpdir.join("off.itf"))
+    shutil.copy(path.join(DATA_PATH, 'simple.itf'), infile)
+    with open(path.join(DATA_PATH, 'simple.itf.ita')) as f:
+        ita = f.read()
+    with open(infile + '.ita', 'w') as f:
+        f.write(ita.replace('.on=true', '.on=false'))
+    outfile = str(tmpdir.join("off.hdf5"))
+    itf2hdf5.main(['--matrix', infile, outfile])
+    df = h5py.File(outfile, 'r')
+    assert '/channels_matrix' not in df
+    assert len(df['/channels'].items()) == 0
+
+
+def test_packed_storage(tmpdir):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    data, cards = reader.read_data(infile)
+    for storage in ['packed24', 'delta']:
+        outfile = str(tmpdir.join(storage + ".hdf5"))
+        itf2hdf5.main(['--storage=' + storage, infile, outfile])
+        df = h5py.File(outfile, 'r')
+        ds = df['/channels/channel_008']
+        assert ds.attrs['storage'] == storage
+        values = reader.read_stored_channel(ds, 100, 200)
+        assert (values == data['channels'][100:200, 8]).all()
+
+
+def test_stores_channel_summaries(tmpdir):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    outfile = str(tmpdir.join("simple.hdf5"))
+    itf2hdf5.main([infile, outfile])
+    data, cards = reader.read_data(infile)
+    channel = data['channels'][:, 13]
+    df = h5py.File(outfile, 'r')
+    attrs = df['/channels/channel_013'].attrs
+    assert attrs['samples'] == len(channel)
+    assert attrs['clip_low_count'] == (channel <= reader.VAL_MIN).sum()
+    assert attrs['clip_high_count'] == (channel >= reader.VAL_MAX).sum()
+    assert attrs['min'] == channel.min()
+    assert attrs['max'] == channel.max()
+    assert abs(attrs['mean'] - channel.mean()) < 1e-6
+    assert df.attrs['missing_samples'] == data['is_missing'].sum()
+
+
+def test_pyramid_overview(tmpdir):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    outfile = str(tmpdir.join("simple.hdf5"))
+    itf2hdf5.main(['--pyramid', '--chunk_size=1000', infile, outfile])
+    data, cards = reader.read_data(infile)
+    channel = data['channels'][:, 13]
+    df = h5py.File(outfile, 'r')
+    level = df['/pyramid/level_16/channel_013'][:]
+    assert len(level) == -(-len(channel) // 16)
+    assert level['max'][3] == channel[48:64].max()
+    assert level['min'][-1] == channel[len(level) * 16 - 16:].min()
+    factor, bins = reader.overview(df, 'channel_013', width=200)
+    assert factor == 16
+    assert (bins == level).all()
+    factor, bins = reader.overview(df, 'channel_013', 1.0, 1.5, width=1000)
+    assert factor == 1
+    assert (bins['mean'] == channel[488:733]).all()
+
+
+def test_hdf5_data_scaled_channels(tmpdir):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    outfile = str(tmpdir.join("simple.hdf5"))
+    itf2hdf5.main([
+        '--storage=delta', '--chunk_size=500', '--channel_names=9:zygo',
+        infile, outfile])
+    data, cards = reader.read_data(infile)
+    expected = data['channels'] * reader.scale_factor(10000)
+    hd = reader.Hdf5Data(outfile, cache_chunks=4)
+    assert len(hd) == len(data)
+    assert hd.channel_names == {'zygo': 9}
+    zygo = hd['zygo']
+    assert zygo.dtype == np.float32
+    assert np.allclose(zygo[1200:1300], expected[1200:1300, 9], rtol=1e-6)
+    # Delta storage decodes the two chunks before those samples too, but
+    # nothing is read again
+    assert hd.chunk_reads == 3
+    zygo[1400:1450]
+    assert hd.chunk_reads == 3
+    assert np.allclose(zygo[::-3], expected[::-3, 9], rtol=1e-6)
+    assert np.allclose(zygo[-1], expected[-1, 9], rtol=1e-6)
+    assert np.allclose(
+        hd[[8, 'zygo'], 100:200], expected[100:200, 8:10], rtol=1e-6)
+    assert len(zygo.seconds(1.0, 2.0)) == 489
+    hd.close()
+
+
+def test_hdf5_data_fills_gaps(tmpdir):
+    frames = open(path.join(DATA_PATH, 'simple.itf'), 'rb').read()
+    size = reader.FRAME_DTYPE.itemsize
+    infile = str(tmpdir.join("gap.itf"))
+    with open(infile, 'wb') as f:
+        f.write(frames[:1000 * size] + frames[1100 * size:])
+    shutil.copy(path.join(DATA_PATH, 'simple.itf.ita'), infile + '.ita')
+    outfile = str(tmpdir.join("gap.hdf5"))
+    itf2hdf5.main(['--chunk_size=64', infile, outfile])
+    raw = reader.Hdf5Data(outfile)['channel_008'][990:1110]
+    hd = reader.Hdf5Data(outfile, fill='linear')
+    assert hd.is_missing[1000:1100].all()
+    filled = hd['channel_008'][1050:1060]
+    step = (raw[110] - raw[9]) / 101.0
+    assert np.allclose(filled, raw[9] + step * np.arange(51, 61), rtol=1e-5)
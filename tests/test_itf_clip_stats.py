@@ -21,3 +21,14 @@ def test_no_crash_on_read_file(capsys):
     itf_clip_stats.main([path.join(DATA_PATH, 'simple.itf')])
     out, err = capsys.readouterr()
     assert 'filename' in out
+
+
+def test_parallel_files_keep_order(capsys):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    files = [infile, path.join(DATA_PATH, 'nope.itf'), infile]
+    itf_clip_stats.main(files)
+    serial_out, _ = capsys.readouterr()
+    itf_clip_stats.main(['--jobs=2'] + files)
+    parallel_out, _ = capsys.readouterr()
+    assert parallel_out == serial_out
+    assert 'nope.itf\terror' in parallel_out
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+from os import path
+
+import numpy as np
+import pytest
+
+from read_itek import itf_export
+from read_itek import reader
+import logging
+itf_export.logger.setLevel(logging.DEBUG)
+
+DATA_PATH = path.join(path.dirname(path.abspath(__file__)), "data")
+
+
+def scaled_channels(infile, channels):
+    data, cards = reader.read_data(infile)
+    return data, data['channels'][:, channels] * reader.scale_factor(10000)
+
+
+def test_shows_help():
+    with pytest.raises(SystemExit):
+        itf_export.main()
+
+
+def test_npz_matches_read_data(tmpdir):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    outfile = str(tmpdir.join("simple.npz"))
+    itf_export.main(['--channel_names=8:emg', '--dtype=float64', infile,
+                     outfile])
+    data, expected = scaled_channels(infile, list(range(8, 16)))
+    exported = np.load(outfile)
+    assert np.allclose(exported['channels'], expected)
+    assert np.array_equal(exported['is_missing'], data['is_missing'])
+    assert np.array_equal(exported['parallel_port'], data['parallel_port'])
+    assert list(exported['channel_numbers']) == list(range(8, 16))
+    assert exported['channel_names'][0] == 'emg'
+
+
+def test_npz_without_zip_open_writes(tmpdir, monkeypatch):
+    monkeypatch.setattr(itf_export, 'ZIP_OPEN_WRITES', False)
+    infile = path.join(DATA_PATH, 'simple.itf')
+    outfile = str(tmpdir.join("simple.npz"))
+    itf_export.main([infile, outfile])
+    data, expected = scaled_channels(infile, list(range(8, 16)))
+    exported = np.load(outfile)
+    assert np.allclose(exported['channels'], expected, rtol=1e-6)
+    assert np.array_equal(exported['is_missing'], data['is_missing'])
+    assert list(exported['channel_numbers']) == list(range(8, 16))
+    assert tmpdir.listdir() == [tmpdir.join("simple.npz")]
+
+
+def test_npy_with_json_metadata(tmpdir):
+    infile = path.join(DATA_PATH, 'simple.itf')
+    outfile = str(tmpdir.join("simple.npy"))
+    itf_export.main([infile, outfile])
+    _, expected = scaled_channels(infile, list(range(8, 16)))
+    exported = np.load(outfile)
+    assert exported.dtype == np.float32
+    assert np.allclose(exported, expected, rtol=1e-6)
+    with open(outfile + '.json') as f:
+        metadata = json.load(f)
+    assert [c['number'] for c in metadata['channels']] == list(range(8, 16))
+    assert metadata['channels'][0]['gain'] == 10000
+
+
+def test_mat_file(tmpdir):
+    h5py = pytest.importorskip('h5py')
+    infile = path.join(DATA_PATH, 'simple.itf')
+    outfile = str(tmpdir.join("simple.mat"))
+    itf_export.main([infile, outfile])
+    with open(outfile, 'rb') as f:
+        header = f.read(itf_export.MAT_USERBLOCK_BYTES)
+    assert header.startswith(b'MATLAB 7.3 MAT-file')
+    assert header[124:128] == b'\x00\x02IM'
+    _, expected = scaled_channels(infile, list(range(8, 16)))
+    with h5py.File(outfile, 'r') as mat:
+        assert mat['channels'].attrs['MATLAB_class'] == b'single'
+        # MATLAB sees this transposed, as samples x channels
+        assert np.allclose(mat['channels'][:].T, expected, rtol=1e-6)
+
+
+def test_parquet_columns(tmpdir):
+    pq = pytest.importorskip('pyarrow.parquet')
+    infile = path.join(DATA_PATH, 'simple.itf')
+    outfile = str(tmpdir.join("simple.parquet"))
+    itf_export.main(['--channel_names=9:emg', infile, outfile])
+    _, expected = scaled_channels(infile, [9])
+    table = pq.read_table(outfile)
+    assert table.schema.names[:2] == ['channel_008', 'emg']
+    assert table.schema.field('emg').metadata[b'number'] == b'9'
+    assert np.allclose(
+        table.column('emg').to_numpy(), expected[:, 0], rtol=1e-6)
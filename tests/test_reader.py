@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import stat
+import shutil
 from os import path
+
+import numpy as np
+import pytest
+
 from read_itek import reader
 import logging
 reader.logger.setLevel(logging.DEBUG)
@@ -25,3 +32,249 @@ def test_skips_broken_data():
     f = open(path.join(DATA_PATH, "padded.itf"), "r")
     frames = reader.read_frames(f)
     assert len(frames) > 0
+
+
+def test_bulk_read_matches_frame_by_frame_read():
+    f = open(path.join(DATA_PATH, "padded.itf"), "rb")
+    slow_frames = list(reader.generate_valid_frames(f))
+    frames = reader.read_frames(f)
+    assert len(slow_frames) > 0
+    assert len(slow_frames) == len(frames)
+    for slow, fast in zip(slow_frames, frames):
+        assert slow.tobytes() == fast.tobytes()
+
+
+def test_read_frames_report():
+    f = open(path.join(DATA_PATH, "padded.itf"), "rb")
+    frames, report = reader.read_frames_report(f)
+    assert report['valid_frames'] == len(frames)
+    assert report['rejected_bytes'] == (
+        report['total_bytes'] - len(frames) * reader.FRAME_DTYPE.itemsize)
+    assert report['rejected_frames'] == 1
+    # The trailing padding doesn't turn into samples
+    data, _ = reader.read_data(path.join(DATA_PATH, "padded.itf"))
+    assert len(data) == len(frames)
+    assert not data['is_missing'].any()
+
+
+def test_resyncs_after_garbage():
+    good = np.fromfile(path.join(DATA_PATH, "simple.itf"), dtype=np.uint8)
+    garbage = np.arange(1000, dtype=np.uint8)
+    buf = np.concatenate([good[:4000], garbage, good[4000:8000]])
+    runs = list(reader.frame_runs(buf))
+    assert runs == [(0, 10), (5000, 10)]
+    assert reader.skipped_ranges(runs, len(buf)) == [(4000, 5000)]
+
+
+def test_mapped_read_matches_read_data():
+    itf_file = path.join(DATA_PATH, "simple.itf")
+    data, cards = reader.read_data(itf_file)
+    mapped, mapped_cards = reader.map_data(itf_file)
+    assert len(mapped) == len(data)
+    assert np.array_equal(mapped[100:2000], data[100:2000])
+    assert mapped_cards == cards
+    mapped.close()
+
+
+def test_iter_blocks_matches_read_data():
+    itf_file = path.join(DATA_PATH, "simple.itf")
+    data, _ = reader.read_data(itf_file)
+    blocks = list(reader.iter_blocks(itf_file, block_size=1000, read_size=999))
+    assert [len(b) for b in blocks] == [1000, 1000, 1000, 774]
+    assert np.array_equal(np.concatenate(blocks), data)
+
+
+def test_storage_round_trip():
+    values = np.array([[0, -1], [reader.VAL_MAX, reader.VAL_MIN], [5, -3]])
+    for storage in reader.STORAGE_MODES:
+        stored = reader.encode_channels(values, storage)
+        assert stored.dtype.base == reader.stored_dtype(storage).base
+        decoded = reader.decode_channels(stored, storage)
+        assert np.array_equal(decoded, values)
+    first = reader.encode_channels(values[:2], 'delta')
+    rest = reader.encode_channels(values[2:], 'delta', values[1])
+    decoded = reader.decode_channels(np.concatenate([first, rest]), 'delta')
+    assert np.array_equal(decoded, values)
+
+
+def test_count_clipped_matches_decoded_data():
+    itf_file = path.join(DATA_PATH, "simple.itf")
+    data, _ = reader.read_data(itf_file)
+    channels = [8, 9, 127]
+    with open(itf_file, "rb") as f:
+        samples, low, high = reader.count_clipped(f, channels, 5000)
+    decoded = data['channels'][:, channels]
+    assert samples == len(data)
+    assert list(low) == list(np.sum(decoded <= reader.VAL_MIN, axis=0))
+    assert list(high) == list(np.sum(decoded >= reader.VAL_MAX, axis=0))
+
+
+def test_read_samples_with_index(tmpdir):
+    itf_file = str(tmpdir.join("simple.itf"))
+    shutil.copy(path.join(DATA_PATH, "simple.itf"), itf_file)
+    data, _ = reader.read_data(itf_file)
+    samples = reader.read_samples(itf_file, 1000, 1010)
+    assert path.exists(reader.index_filename(itf_file))
+    assert np.array_equal(samples, data[1000:1010])
+    seconds = reader.read_seconds(itf_file, 1.0, 2.0)
+    assert np.array_equal(seconds, data[488:977])
+
+
+def test_rebuilds_damaged_index(tmpdir):
+    itf_file = str(tmpdir.join("simple.itf"))
+    shutil.copy(path.join(DATA_PATH, "simple.itf"), itf_file)
+    data, _ = reader.read_data(itf_file)
+    reader.save_index(itf_file, reader.build_index(itf_file))
+    with open(reader.index_filename(itf_file), "r+b") as f:
+        f.truncate(100)
+    samples = reader.read_samples(itf_file, 1000, 1010)
+    assert np.array_equal(samples, data[1000:1010])
+    assert reader.load_index(itf_file)['file_size'] == path.getsize(itf_file)
+
+
+def test_index_gets_default_permissions(tmpdir):
+    itf_file = str(tmpdir.join("simple.itf"))
+    shutil.copy(path.join(DATA_PATH, "simple.itf"), itf_file)
+    umask = os.umask(0o022)
+    try:
+        reader.save_index(itf_file, reader.build_index(itf_file))
+    finally:
+        os.umask(umask)
+    mode = os.stat(reader.index_filename(itf_file)).st_mode
+    assert stat.S_IMODE(mode) == 0o644
+
+
+def test_follow_reader_reads_appended_frames(tmpdir):
+    source = np.fromfile(path.join(DATA_PATH, "simple.itf"), dtype=np.uint8)
+    itf_file = str(tmpdir.join("growing.itf"))
+    follower = reader.FollowReader(itf_file)
+    pieces = []
+    for start in range(0, len(source), 150000):
+        with open(itf_file, "ab") as f:
+            f.write(source[start:start + 150000].tobytes())
+        pieces.append(follower.read_new())
+    data, _ = reader.read_data(path.join(DATA_PATH, "simple.itf"))
+    assert len(pieces[0]) == 150000 // 400
+    assert np.array_equal(np.concatenate(pieces), data)
+
+
+def test_unpack_channels_into_internal_type():
+    frames = np.zeros(4, dtype=reader.FRAME_DTYPE)
+    samples = [
+        ([0x7F, 0xFF, 0xFF], reader.VAL_MAX),
+        ([0x80, 0x00, 0x00], reader.VAL_MIN),
+        ([0xFF, 0xFF, 0xFF], -1),
+        ([0x00, 0x00, 0x01], 1),
+    ]
+    for i, (sample_bytes, _) in enumerate(samples):
+        frames['chans127to109'][i, 0] = sample_bytes
+        frames['chans08to00'][i, 8] = sample_bytes
+    internal = reader.empty_internal_type(4)
+    reader.unpack_channels(frames, internal['channels'])
+    expected = [value for _, value in samples]
+    assert list(internal['channels'][:, 127]) == expected
+    assert list(internal['channels'][:, 0]) == expected
+    assert not internal['channels'][:, 1:127].any()
+
+
+def test_reads_channel_subset():
+    itf_file = path.join(DATA_PATH, "simple.itf")
+    data, cards = reader.read_data(itf_file)
+    channels = [127, 3, 64, 0]
+    subset, _ = reader.read_data(itf_file, channels=channels)
+    assert subset['channels'].shape == (len(data), len(channels))
+    assert np.array_equal(subset['channels'], data['channels'][:, channels])
+    assert np.array_equal(subset['is_missing'], data['is_missing'])
+    blocks = list(reader.iter_blocks(
+        itf_file, block_size=1000, read_size=999, channels=channels))
+    assert np.array_equal(np.concatenate(blocks), subset)
+
+
+def test_fill_gaps():
+    channels = np.array([0, 10, 0, 0, 40, 0], dtype='<i4')
+    is_missing = np.array([1, 0, 1, 1, 0, 1], dtype=bool)
+    hold = reader.fill_gaps(channels, is_missing, 'hold')
+    assert list(hold) == [10, 10, 10, 10, 40, 40]
+    assert hold.dtype == channels.dtype
+    linear = reader.fill_gaps(channels, is_missing, 'linear')
+    assert list(linear) == [10, 10, 20, 30, 40, 40]
+    nan = reader.fill_gaps(channels, is_missing, 'nan')
+    assert list(np.isnan(nan)) == list(is_missing)
+    linear = reader.fill_gaps(
+        channels, is_missing, 'linear', before=(1, 0), after=(1, 0))
+    assert list(linear) == [5, 10, 20, 30, 40, 20]
+
+
+def test_fill_gap_blocks_spanning_blocks():
+    data, _ = reader.read_data(path.join(DATA_PATH, "simple.itf"))
+    data['is_missing'][990:2300] = True
+    data['channels'][990:2300] = 0
+    expected = reader.fill_gaps(data['channels'], data['is_missing'], 'linear')
+    blocks = [data[i:i + 500] for i in range(0, len(data), 500)]
+    filled = list(reader.fill_gap_blocks(iter(blocks), 'linear'))
+    assert [len(b) for b, _ in filled] == [len(b) for b in blocks]
+    assert np.allclose(np.concatenate([f for _, f in filled]), expected)
+
+
+def test_long_gaps_from_skipped_bytes(tmpdir):
+    itf_file = path.join(DATA_PATH, "simple.itf")
+    data, _ = reader.read_data(itf_file)
+    raw = open(itf_file, 'rb').read()
+    size = reader.FRAME_DTYPE.itemsize
+    # 400 frames of corruption: more than the record counter can count
+    gap_file = str(tmpdir.join("gap.itf"))
+    with open(gap_file, 'wb') as f:
+        f.write(raw[:1000 * size] + b'\x00' * (400 * size) + raw[1400 * size:])
+    short, _ = reader.read_data(gap_file)
+    assert len(short) == len(data) - 256
+    rebuilt, _ = reader.read_data(gap_file, long_gaps=True)
+    assert len(rebuilt) == len(data)
+    assert np.array_equal(rebuilt['channels'][1400:], data['channels'][1400:])
+    assert rebuilt['is_missing'][1000:1400].all()
+    blocks = list(reader.iter_blocks(
+        gap_file, block_size=1000, read_size=999, long_gaps=True))
+    assert np.array_equal(np.concatenate(blocks), rebuilt)
+
+
+def test_ambiguous_gaps():
+    size = reader.FRAME_DTYPE.itemsize
+    counter = np.array([10, 11, 12, 140], dtype=np.uint8)
+    # 640 frames' worth of bytes: 128 + 2 * 256 is 640, so that's clear
+    offsets = np.array([0, 1, 2, 642]) * size
+    rnums = reader.unwrap_record_numbers(counter, offsets=offsets)
+    assert list(rnums) == [0, 1, 2, 642]
+    assert len(reader.ambiguous_gaps(counter, offsets)) == 0
+    # 256 frames' worth is halfway between 128 and 128 + 256
+    offsets = np.array([0, 1, 2, 258]) * size
+    assert list(reader.ambiguous_gaps(counter, offsets)) == [3]
+
+
+def test_mapped_frames_outlive_close():
+    mapped = reader.MappedItf(path.join(DATA_PATH, "simple.itf"))
+    frames = mapped.frames(0, 10)
+    mapped.close()
+    assert list(frames['recordNumber']) == list(frames['sameRecordNumber'])
+    assert len(frames) == 10
+    with pytest.raises(ValueError):
+        mapped.read(0, 10)
+
+
+def test_maps_empty_file(tmpdir):
+    itf_file = str(tmpdir.join("empty.itf"))
+    open(itf_file, 'wb').close()
+    mapped = reader.MappedItf(itf_file)
+    assert len(mapped) == 0
+    assert len(mapped.read()) == 0
+    data, _ = reader.read_data(itf_file)
+    assert len(data) == 0
+
+
+def test_repeated_record_number_beside_dropped_frame():
+    f = open(path.join(DATA_PATH, "simple.itf"), "rb")
+    frames = reader.read_frames(f)
+    kept = frames[list(range(10)) + [9, 10] + list(range(12, 20))]
+    data = reader.convert_frames_to_internal_type(kept)
+    expected, _ = reader.read_data(path.join(DATA_PATH, "simple.itf"))
+    assert np.array_equal(data['channels'][:11], expected['channels'][:11])
+    assert np.array_equal(data['channels'][12:], expected['channels'][12:20])
+    assert list(np.nonzero(data['is_missing'])[0]) == [11]